@@ -0,0 +1,168 @@
+import re
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from getmarketdata import GetData, ThrottledError
+from latency import default_recorder
+
+MINUTE = 60.0
+DAY = 24 * 60 * 60.0
+
+
+def with_token(url, token):
+    """Alpha Vantage URL with its apikey replaced by `token`."""
+    return re.sub(r'apikey=[^&]*', lambda match: 'apikey=' + token, url)
+
+
+class TokenBudget:
+    """Sliding-window call budget of one Alpha Vantage token."""
+    def __init__(self, token, per_minute=5, per_day=500):
+
+        self.token = token
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.calls = deque()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        while self.calls and now - self.calls[0] >= DAY:
+            self.calls.popleft()
+
+        wait = max(self.blocked_until - now, 0.0)
+
+        if len(self.calls) >= self.per_day:
+            wait = max(wait, self.calls[-self.per_day] + DAY - now)
+
+        last_minute = [t for t in self.calls if now - t < MINUTE]
+        if len(last_minute) >= self.per_minute:
+            wait = max(wait, last_minute[-self.per_minute] + MINUTE - now)
+
+        return wait
+
+    def consume(self, now):
+        self.calls.append(now)
+
+    def block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class AVScheduler:
+    """Schedules Alpha Vantage requests across one or more tokens without
+    exceeding their per-minute and per-day limits. Calls that find no budget
+    wait for it instead of failing, identical in-flight requests are merged
+    into one call, and a token answered with a rate-limit notice is rested
+    before being used again while the call is retried on another token.
+    Other errors are raised right away. Responses served from the response
+    cache do not use any budget.
+
+    Parameters
+    ----------
+    tokens: dict
+    Tokens as used by GetData, 'av_token' being a token or a list of tokens
+    output_format: str
+    'json' or 'csv'
+    per_minute: int
+    Calls allowed per token per minute
+    per_day: int
+    Calls allowed per token per day
+    retries: int
+    Number of times a throttled call is retried on another token
+    """
+    def __init__(self, tokens, output_format='json', per_minute=5, per_day=500, retries=2, **kwargs):
+
+        av_tokens = tokens['av_token']
+        if isinstance(av_tokens, str):
+            av_tokens = [av_tokens]
+
+        self.budgets = [TokenBudget(token, per_minute, per_day) for token in av_tokens]
+        self.client = GetData(dict(tokens, av_token=av_tokens[0]), output_format, **kwargs)
+        self.retries = retries
+
+        self.condition = threading.Condition()
+        self.inflight = {}
+
+    def acquire(self):
+        with default_recorder.span('av_wait'), self.condition:
+            while True:
+                now = time.monotonic()
+                waits = [(budget.wait_time(now), i) for i, budget in enumerate(self.budgets)]
+                wait, i = min(waits)
+
+                if wait <= 0:
+                    self.budgets[i].consume(now)
+                    return self.budgets[i]
+
+                self.condition.wait(wait)
+
+    def release(self, budget, throttled):
+        with self.condition:
+            if throttled:
+                budget.block(time.monotonic(), MINUTE)
+            self.condition.notify_all()
+
+    def call(self, timestamp, function, symbol, interval, request):
+        for attempt in range(self.retries + 1):
+            budgets = []
+
+            def acquire(url):
+                budget = self.acquire()
+                budgets.append(budget)
+                return with_token(url, budget.token)
+
+            try:
+                raw_data = self.client.get_av_data(timestamp, function, symbol, interval, request, acquire=acquire)
+            except ThrottledError as msg:
+                self.release(budgets[0], throttled=True)
+                if attempt == self.retries:
+                    raise
+                logging.warning('Alpha Vantage token throttled, retrying: {}'.format(msg))
+                continue
+            except BaseException:
+                if budgets:
+                    self.release(budgets[0], throttled=False)
+                raise
+
+            if budgets:
+                self.release(budgets[0], throttled=False)
+            return raw_data
+
+    def get_av_data(self, timestamp, function=None, symbol=None, interval=None, request=None):
+        key = (function, symbol, interval, request)
+
+        with self.condition:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            raw_data = self.call(timestamp, function, symbol, interval, request)
+        except BaseException as msg:
+            future.set_exception(msg)
+            raise
+        else:
+            future.set_result(raw_data)
+            return raw_data
+        finally:
+            with self.condition:
+                del self.inflight[key]
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(tokens, output_format='json', **kwargs):
+    """Returns the process-wide scheduler of the given Alpha Vantage tokens,
+    so their budgets are shared by every caller."""
+    av_tokens = tokens['av_token']
+    key = (tuple(av_tokens) if isinstance(av_tokens, (list, tuple)) else av_tokens, output_format)
+
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = AVScheduler(tokens, output_format, **kwargs)
+        return _schedulers[key]
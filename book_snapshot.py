@@ -0,0 +1,79 @@
+import struct
+import numpy as np
+
+HEADER = struct.Struct('<4sHHHH')
+MAGIC = b'OBK1'
+
+
+class OrderBookSnapshot:
+    """Order-book snapshot of one symbol backed by contiguous float64 arrays,
+    one price and one size array per side, best level first.
+
+    Parameters
+    ----------
+    symbol: str
+    Symbol of the book
+    timestamp: str
+    Timestamp of the snapshot
+    bid_price, bid_size, ask_price, ask_size: numpy.ndarray
+    Prices and sizes of the book levels
+    """
+    __slots__ = ('symbol', 'timestamp', 'bid_price', 'bid_size', 'ask_price', 'ask_size')
+
+    def __init__(self, symbol, timestamp, bid_price, bid_size, ask_price, ask_size):
+
+        self.symbol = symbol
+        self.timestamp = timestamp
+        self.bid_price = np.ascontiguousarray(bid_price, dtype=np.float64)
+        self.bid_size = np.ascontiguousarray(bid_size, dtype=np.float64)
+        self.ask_price = np.ascontiguousarray(ask_price, dtype=np.float64)
+        self.ask_size = np.ascontiguousarray(ask_size, dtype=np.float64)
+
+    @classmethod
+    def from_iex(cls, symbol, book, timestamp):
+        """Builds a snapshot from the {'bids': [...], 'asks': [...]} book of
+        an IEX /deep/book response."""
+        bids, asks = book['bids'], book['asks']
+        return cls(symbol, timestamp,
+                   np.fromiter((level['price'] for level in bids), np.float64, len(bids)),
+                   np.fromiter((level['size'] for level in bids), np.float64, len(bids)),
+                   np.fromiter((level['price'] for level in asks), np.float64, len(asks)),
+                   np.fromiter((level['size'] for level in asks), np.float64, len(asks)))
+
+    @property
+    def levels(self):
+        return max(len(self.bid_price), len(self.ask_price))
+
+    def to_bytes(self):
+        symbol = self.symbol.encode('utf-8')
+        timestamp = self.timestamp.encode('utf-8')
+        return b''.join((HEADER.pack(MAGIC, len(symbol), len(timestamp), len(self.bid_price), len(self.ask_price)),
+                         symbol, timestamp, self.bid_price.tobytes(), self.bid_size.tobytes(),
+                         self.ask_price.tobytes(), self.ask_size.tobytes()))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Reads a snapshot written by to_bytes, the arrays being views over
+        `data`."""
+        magic, symbol_len, timestamp_len, n_bids, n_asks = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('Not an order book snapshot')
+
+        offset = HEADER.size
+        symbol = bytes(data[offset:offset + symbol_len]).decode('utf-8')
+        offset += symbol_len
+        timestamp = bytes(data[offset:offset + timestamp_len]).decode('utf-8')
+        offset += timestamp_len
+
+        arrays = []
+        for count in (n_bids, n_bids, n_asks, n_asks):
+            arrays.append(np.frombuffer(data, np.float64, count, offset))
+            offset += count * 8
+
+        return cls(symbol, timestamp, *arrays)
+
+    def to_record(self):
+        """JSON-serializable record with one list per array."""
+        return {'symbol': self.symbol, 'Timestamp': self.timestamp,
+                'bid_price': self.bid_price.tolist(), 'bid_size': self.bid_size.tolist(),
+                'ask_price': self.ask_price.tolist(), 'ask_size': self.ask_size.tolist()}
@@ -0,0 +1,220 @@
+import os
+import re
+import time
+import zlib
+import pickle
+import struct
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+RECORD = struct.Struct('<II')
+
+
+class CheckpointLog:
+    """Append-only key/value checkpoint log. Every update appends one
+    length- and crc32-framed pickled (key, value) record, so it costs the size
+    of the record and not of the whole state. Appends are fsynced in batches
+    of `sync_every` records or every `sync_interval` seconds, and the log is
+    compacted into one record per live key once it holds `compact_ratio`
+    times more records than keys.
+
+    On opening, the log is replayed into memory and a torn record left by a
+    crash at its tail is truncated. A log has a single writer: the process
+    opening it holds an exclusive lock on `path`.lock until it closes it, so
+    a compaction never replaces the file under another process.
+
+    Parameters
+    ----------
+    path: str
+    Log file
+    sync_every: int
+    Number of appended records after which the log is fsynced
+    sync_interval: float
+    Seconds after which pending records are fsynced
+    compact_ratio: float
+    Ratio of records to live keys triggering a compaction
+    compact_min: int
+    Number of records under which the log is never compacted
+    """
+    def __init__(self, path, sync_every=64, sync_interval=1.0, compact_ratio=4.0, compact_min=1024):
+
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+
+        self.lock = threading.RLock()
+        self.state = {}
+        self.records = 0
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+        self.lock_file = open(path + '.lock', 'ab')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.lock_file.close()
+                raise RuntimeError('{} is used by another process'.format(path))
+
+        self.replay()
+        self.file = open(path, 'ab')
+
+    def replay(self):
+        if not os.path.exists(self.path):
+            return
+
+        good = 0
+        with open(self.path, 'rb') as file:
+            while True:
+                header = file.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                length, crc = RECORD.unpack(header)
+                data = file.read(length)
+                if len(data) < length or zlib.crc32(data) != crc:
+                    break
+
+                self.apply(pickle.loads(data))
+                self.records += 1
+                good = file.tell()
+
+        if good < os.path.getsize(self.path):
+            logging.warning('Truncating a torn record at the end of {}'.format(self.path))
+            with open(self.path, 'r+b') as file:
+                file.truncate(good)
+
+    def apply(self, record):
+        """Applies a (key, value) record, or a (key,) deletion."""
+        if len(record) == 1:
+            self.state.pop(record[0], None)
+        else:
+            self.state[record[0]] = record[1]
+
+    @staticmethod
+    def encode(record):
+        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        return RECORD.pack(len(data), zlib.crc32(data)) + data
+
+    def append(self, records):
+        data = b''.join(self.encode(record) for record in records)
+        with self.lock:
+            self.file.write(data)
+            self.records += len(records)
+            self.pending += len(records)
+
+            for record in records:
+                self.apply(record)
+
+            if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self.sync()
+
+            if self.records >= self.compact_min and self.records > self.compact_ratio * max(len(self.state), 1):
+                self.compact()
+
+    def put(self, key, value):
+        self.append([(key, value)])
+
+    def update(self, mapping):
+        """Appends one record per item of `mapping` with a single write."""
+        self.append(list(mapping.items()))
+
+    def delete(self, key):
+        self.append([(key,)])
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.state.get(key, default)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.state
+
+    def items(self):
+        with self.lock:
+            return list(self.state.items())
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending = 0
+            self.last_sync = time.monotonic()
+
+    def compact(self):
+        """Rewrites the log with one record per live key, replacing the old
+        log atomically."""
+        with self.lock:
+            tmp_path = self.path + '.compact'
+            with open(tmp_path, 'wb') as file:
+                file.write(b''.join(self.encode(item) for item in self.state.items()))
+                file.flush()
+                os.fsync(file.fileno())
+
+            self.file.close()
+            os.replace(tmp_path, self.path)
+            self.file = open(self.path, 'ab')
+            self.records = len(self.state)
+            self.pending = 0
+            self.last_sync = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.sync()
+                self.file.close()
+                self.lock_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_checkpoints = {}
+_checkpoints_lock = threading.Lock()
+
+def get_checkpoint(path='checkpoint.log', **kwargs):
+    """Returns the CheckpointLog of this process for `path`, shared by the
+    producer and the spiders running in it."""
+    path = os.path.abspath(path)
+    with _checkpoints_lock:
+        if path not in _checkpoints or _checkpoints[path].file.closed:
+            _checkpoints[path] = CheckpointLog(path, **kwargs)
+        return _checkpoints[path]
+
+
+def checkpoint_scope(*parts):
+    """Name of the data a producer ingests (source, symbol, request...), used
+    in its checkpoint keys and default log path."""
+    return re.sub(r'[^A-Za-z0-9.=-]+', '_', '-'.join(str(part) for part in parts if part)).strip('_') or 'default'
+
+
+def default_checkpoint_path(scope):
+    return 'checkpoint.{}.log'.format(scope)
+
+
+def checkpointed(checkpoint, name, fn, scope=None):
+    """Wraps a TickScheduler source so the timestamp of each tick it finishes
+    is recorded under ('tick', scope, name)."""
+    def run(timestamp):
+        fn(timestamp)
+        checkpoint.put(('tick', scope, name), timestamp)
+    return run
+
+
+def resume_offset(checkpoint, name, cadence, now=None, scope=None):
+    """Offset of the first tick of a source resuming after a restart: the
+    tick after the last one it finished, or right away when that is already
+    due."""
+    last_tick = checkpoint.get(('tick', scope, name))
+    if last_tick is None:
+        return 0.0
+    return max(last_tick + cadence - (time.time() if now is None else now), 0.0)
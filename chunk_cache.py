@@ -0,0 +1,73 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+def schema_hash(cursor, *tables):
+    """Hashes the column names and types of the given tables so cached chunks
+    are invalidated when the schema changes."""
+    digest = hashlib.sha1()
+    for table in tables:
+        cursor.execute("SELECT * FROM {} LIMIT 0;".format(table))
+        digest.update(repr([column[:2] for column in cursor.description]).encode('utf-8'))
+        cursor.fetchall()
+    return digest.hexdigest()
+
+
+class ChunkCache:
+    """On-disk cache of chunk arrays stored as .npy files and read back
+    memory-mapped, so repeated experiments are served from the page cache
+    instead of the database.
+
+    Parameters
+    ----------
+    directory: str
+    Root directory of the cache, one subdirectory per key
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                part = part.tobytes()
+            digest.update(repr(part).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key, names):
+        """Returns a dict of copy-on-write memory-mapped arrays, or None when
+        the entry is missing."""
+        path = self.path(key)
+        try:
+            return {name: np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode='c') for name in names}
+        except FileNotFoundError:
+            return None
+
+    def store(self, key, **arrays):
+        """Writes the arrays into a temporary directory that is renamed into
+        place, so readers never see a partially written entry."""
+        path = self.path(key)
+        if os.path.isdir(path):
+            return
+
+        tmp_path = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, '{}.npy'.format(name)), np.ascontiguousarray(array))
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
@@ -0,0 +1,150 @@
+import numpy as np
+import torch
+
+HEAD, BODY, TAIL, HEAD_TAIL = 0, 1, 2, 3
+SEGMENTS = 4
+
+
+class ChunkStatistics:
+    """Computes the per-chunk MIN/MAX normalization parameters of the chunk
+    layout used by MySQLChunkLoader in a single pass over the table.
+
+    Every ID bucket of `chunk_size` rows is split into segments: the head
+    (IDs below `window`, only present in the first bucket and left out of
+    the first chunk), the body and the tail (the last `window - 1` IDs,
+    shared with the next chunk). When the head and the tail of the first
+    bucket overlap, their common IDs form a head-tail segment that only
+    belongs to the second chunk. A chunk is then the union of its own bucket
+    and the tail of the previous one, so its statistics are reduced from the
+    segment statistics without touching the database again.
+
+    Parameters
+    ----------
+    x_fields: list
+    Fields selected by the X query
+    from_statement: str
+    FROM clause of the X query
+    chunk_size: int
+    Number of rows per chunk
+    window: int
+    Size of the sliding window
+    method: str
+    'grouped' sends one GROUP BY aggregate query, 'scan' streams the rows once
+    and reduces them on the client
+    bucket_expr: str
+    SQL expression mapping an ID to its bucket for the 'grouped' method
+    fetch_size: int
+    Number of rows fetched per round-trip for the 'scan' method
+    """
+    def __init__(self, x_fields, from_statement, chunk_size, window, method='grouped',
+                 bucket_expr='FLOOR(ID / {chunk_size})', fetch_size=10000):
+
+        assert method in ('grouped', 'scan'), '{} method is not supported'.format(method)
+        assert window <= chunk_size + 1, 'Window must not be longer than chunk_size + 1'
+
+        self.x_fields = x_fields
+        self.from_statement = from_statement
+        self.chunk_size = chunk_size
+        self.window = window
+        self.bucket_expr = bucket_expr.format(chunk_size=chunk_size)
+        self.fetch_size = fetch_size
+        self.method = method
+
+    def segment_of(self, ids):
+        ids = np.asarray(ids)
+        head = (ids < self.window) & (ids < self.chunk_size)
+        tail = ids % self.chunk_size > self.chunk_size - self.window
+        return np.where(head, np.where(tail, HEAD_TAIL, HEAD), np.where(tail, TAIL, BODY))
+
+    def empty_segments(self, num_buckets):
+        shape = (num_buckets, SEGMENTS, len(self.x_fields))
+        return np.full(shape, np.nan), np.full(shape, np.nan)
+
+    def compute_segments(self, cursor, db_length, start_id=1):
+        """Returns the (seg_min, seg_max) arrays of shape (buckets, 4, fields)
+        for the rows with `start_id <= ID <= db_length`."""
+        num_buckets = db_length // self.chunk_size + 1
+        seg_min, seg_max = self.empty_segments(num_buckets)
+
+        if self.method == 'grouped':
+            self._grouped(cursor, db_length, start_id, seg_min, seg_max)
+        else:
+            self._scan(cursor, db_length, start_id, seg_min, seg_max)
+
+        return seg_min, seg_max
+
+    def extend_segments(self, cursor, seg_min, seg_max, old_length, db_length):
+        """Merges the statistics of the rows appended after `old_length` into
+        previously computed segment statistics, only scanning the new rows."""
+        if db_length <= old_length:
+            return seg_min, seg_max
+
+        new_min, new_max = self.compute_segments(cursor, db_length, start_id=old_length + 1)
+
+        num_buckets = len(seg_min)
+        new_min[:num_buckets] = np.fmin(new_min[:num_buckets], seg_min)
+        new_max[:num_buckets] = np.fmax(new_max[:num_buckets], seg_max)
+
+        return new_min, new_max
+
+    def _grouped(self, cursor, db_length, start_id, seg_min, seg_max):
+        segment_expr = "CASE WHEN ID < {w} AND ID < {cs} AND ID % {cs} > {cs} - {w} THEN {head_tail} " \
+                       "WHEN ID < {w} AND ID < {cs} THEN {head} " \
+                       "WHEN ID % {cs} > {cs} - {w} THEN {tail} ELSE {body} END"\
+            .format(w=self.window, cs=self.chunk_size, head=HEAD, body=BODY, tail=TAIL, head_tail=HEAD_TAIL)
+        min_fields = ", ".join("MIN({})".format(i) for i in self.x_fields)
+        max_fields = ", ".join("MAX({})".format(i) for i in self.x_fields)
+
+        cursor.execute("SELECT {bucket} AS bucket, {segment} AS segment, {min_fields}, {max_fields} {from_statement} "
+                       "WHERE ID BETWEEN {lo} AND {hi} GROUP BY bucket, segment;"
+                       .format(bucket=self.bucket_expr, segment=segment_expr, min_fields=min_fields,
+                               max_fields=max_fields, from_statement=self.from_statement, lo=start_id, hi=db_length))
+
+        n = len(self.x_fields)
+        for row in cursor.fetchall():
+            bucket, segment = int(row[0]), int(row[1])
+            values = np.array(row[2:], dtype=np.float64)
+            seg_min[bucket, segment] = values[:n]
+            seg_max[bucket, segment] = values[n:]
+
+    def _scan(self, cursor, db_length, start_id, seg_min, seg_max):
+        cursor.execute("SELECT ID, {fields} {from_statement} WHERE ID BETWEEN {lo} AND {hi};"
+                       .format(fields=", ".join(self.x_fields), from_statement=self.from_statement,
+                               lo=start_id, hi=db_length))
+
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if not rows:
+                break
+
+            rows = np.array(rows, dtype=np.float64)
+            ids = rows[:, 0].astype(np.int64)
+            key = (ids // self.chunk_size, self.segment_of(ids))
+
+            np.fmin.at(seg_min, key, rows[:, 1:])
+            np.fmax.at(seg_max, key, rows[:, 1:])
+
+    def reduce_chunks(self, seg_min, seg_max):
+        """Reduces segment statistics to the per-chunk (x_min, x_max) arrays."""
+        x_min = np.fmin(seg_min[:, BODY], seg_min[:, TAIL])
+        x_max = np.fmax(seg_max[:, BODY], seg_max[:, TAIL])
+
+        x_min[1:] = np.fmin(x_min[1:], np.fmin(seg_min[:-1, TAIL], seg_min[:-1, HEAD_TAIL]))
+        x_max[1:] = np.fmax(x_max[1:], np.fmax(seg_max[:-1, TAIL], seg_max[:-1, HEAD_TAIL]))
+
+        return x_min, x_max
+
+    def norm_params(self, seg_min, seg_max):
+        """Returns the norm_params list of (x_min, x_max) tensors of shape
+        (1, fields), widening constant fields so they can be normalized."""
+        x_min, x_max = self.reduce_chunks(seg_min, seg_max)
+
+        constant = x_min == x_max
+        x_max[constant] += np.where(x_max[constant] != 0, x_max[constant] * 0.001, 0.001)
+
+        return [(torch.tensor(chunk_min[None, :], dtype=torch.float32),
+                 torch.tensor(chunk_max[None, :], dtype=torch.float32))
+                for chunk_min, chunk_max in zip(x_min, x_max)]
+
+    def compute(self, cursor, db_length):
+        return self.norm_params(*self.compute_segments(cursor, db_length))
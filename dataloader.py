@@ -1,102 +1,145 @@
+import os
 import torch 
 import pickle 
+import numpy as np
 from torch.utils.data import Dataset 
-from itertools import islice 
-from config import bid_levels, ask_levels
-
-def window_indices(seq, n=2):
-    it = iter(seq)
-    result = tuple(islice(it, n))
-    if len(result) == n:
-        yield result 
-    from elem in it: 
-        result = result[1:] + (elem,)
-        yield result 
-    
-class MySQLChunkLoader(Dataset):
-    def __init__(self, cursor, table, db_x_query, chunk_size, window):
-
-        cursor.execute("SELECT COUNT(ID) FROM {};".format(table))
-        db_length = cursor.fetchone()[0]
-
-        self.num_chunks = db_length // chunk_size 
-        self.chunk_indices = []
-
-        for chunk in range(self.num_chunks + 1):
-            if chunk == 0:
-                self.chunk_indices.append(range(window, chunk_size))
-            elif chunk < (db_length // chunk_size):
-                self.chunk_indices.append(range(chunk_size * chunk - window + 1, chunk_size * (chunk + 1)))
-            else:
-                self.chunk_indices.append(range(chunk_size * chunk - window + 1, db_length + 1))
+from chunk_stats import ChunkStatistics, SEGMENTS
+from chunk_cache import schema_hash
+from orderbook import OrderBookLayout
+from db_pool import borrowed_cursor
 
+def parse_x_query(db_x_query):
     db_x_query = [w.strip(",") for w in db_x_query.split()]
     fields_start_idx = db_x_query.index("SELECT")
     fields_end_idx = db_x_query.index("FROM")
-    self.x_fields = db_x_query[fields_start_idx + 1: fields_end_idx]
+    x_fields = db_x_query[fields_start_idx + 1: fields_end_idx]
 
     from_start_idx = db_x_query.index("FROM")
-    from_statement = "".join(db_x_query[from_start_idx:]).strip(";")
+    from_statement = " ".join(db_x_query[from_start_idx:]).strip(";")
 
-    self.norm_params = []
+    return x_fields, from_statement
 
-    x_min_fields = "".join(["MIN({}), ".format(i) for i in self.x_fields]).strip(", ")
-    x_max_fields = x_min_fields.replace("MIN", "MAX")
+class MySQLChunkLoader(Dataset):
+    def __init__(self, cursor, table, db_x_query, chunk_size, window, stats_method='grouped', cache=None,
+                 state_path=None, bid_levels=None, ask_levels=None):
 
-    for chunk in range(self.num_chunks + 1):
-        cursor.execute("SELECT {} {} WHERE ID IN {};"\
-            .format(x_min_fields, from_statement, tuple(self.chunk_indices[chunk])))
-        
-        x_min = torch.Tensor(cursor.fetchall())
+        assert state_path is None or cache is None, 'state_path and cache cannot be used together'
 
-        cursor.execute("SELECT {} {} WHERE ID IN {};"\
-            .format(x_max_fields, from_statement, tuple(self.chunk_indices[chunk])))
-        
-        x_max = torch.Tensor(cursor.fetchall())
+        with borrowed_cursor(cursor) as cursor:
 
-        for i, _ in enumerate(zip(x_min[0], x_max[0])):
-            if x_min[0][i] == x_max[0][i]:
-                if x_max[0][i] != 0:
-                    x_max[0][i] += x_max[0][i] * 0.001
-                else:
-                    x_max[0][i] += 0.001
+            state = None
+            if state_path is not None:
+                state = self.load_state(state_path, table, db_x_query, chunk_size, window)
 
-        self.norm_params.append((x_min, x_max))
-
-    if "sd.bid_0_size" in self.x_fields:
+            if state is None:
+                cursor.execute("SELECT COUNT(ID) FROM {};".format(table))
+                db_length = cursor.fetchone()[0]
+            else:
+                cursor.execute("SELECT COUNT(ID) FROM {} WHERE ID > {};".format(table, state["db_length"]))
+                db_length = state["db_length"] + cursor.fetchone()[0]
 
-        ask = ["sd.ask_{}_size".format(i) for i in range(ask_levels)]
-        bid = ["sd.bid_{}_size".format(i) for i in range(bid_levels)]
+            self.num_chunks = db_length // chunk_size 
+            self.chunk_indices = []
 
-        ask_idx = []
-        for i in ask:
-            try:
-                ask_idx.append(self.x_fields.index(i))
-            except ValueError:
-                continue 
+            for chunk in range(self.num_chunks + 1):
+                if chunk == 0:
+                    self.chunk_indices.append(range(window, chunk_size))
+                elif chunk < (db_length // chunk_size):
+                    self.chunk_indices.append(range(chunk_size * chunk - window + 1, chunk_size * (chunk + 1)))
+                else:
+                    self.chunk_indices.append(range(chunk_size * chunk - window + 1, db_length + 1))
 
-        bid_idx = []
-        for i in bid:
-            try:
-                bid_idx.append(self.x_fields.index(i))
-            except ValueError:
-                continue 
+            self.x_fields, from_statement = parse_x_query(db_x_query)
 
-        for x_min, x_max in self.norm_params:
-            if ask_idx: 
-                x_min[0][ask_idx] = min(x_min[0][ask_idx])
-                x_max[0][ask_idx] = max(x_max[9][ask_idx])
-            if bid_idx:
-                x_min[0][bid_idx] = min(x_min[0][bid_idx])
-                x_max[0][bid_idx] = max(x_max[0][bid_idx])
+            stats = ChunkStatistics(self.x_fields, from_statement, chunk_size, window, method=stats_method)
 
-        params_dict = {}
+            if state_path is not None:
+                if state is None:
+                    seg_min, seg_max = stats.compute_segments(cursor, db_length)
+                else:
+                    seg_min, seg_max = stats.extend_segments(cursor, state["seg_min"], state["seg_max"],
+                                                             state["db_length"], db_length)
 
-        for i, name in enumerate(self.x_fields):
-            params_dict[name] = {"MIN": self.norm_params[-1][0][0][i], "MAX": self.norm_params[-1][1][0][i]}
+                self.norm_params = stats.norm_params(seg_min, seg_max)
 
-        with open("norm_params", "wb") as file:
-            pickle.dump(params_dict, file)
+                self.save_state(state_path, {"table": table, "db_x_query": db_x_query, "chunk_size": chunk_size,
+                                             "window": window, "db_length": db_length,
+                                             "seg_min": seg_min, "seg_max": seg_max})
+            elif cache is None:
+                self.norm_params = stats.compute(cursor, db_length)
+            else:
+                self.norm_params = self.cached_norm_params(cache, stats, cursor, table, db_x_query, db_length)
+
+        self.book_layout = None
+
+        if "sd.bid_0_size" in self.x_fields:
+
+            if bid_levels is None or ask_levels is None:
+                import config
+                bid_levels = config.bid_levels if bid_levels is None else bid_levels
+                ask_levels = config.ask_levels if ask_levels is None else ask_levels
+
+            self.book_layout = OrderBookLayout(self.x_fields, bid_levels, ask_levels)
+            self.norm_params = self.book_layout.pool_norm_params(self.norm_params)
+
+            params_dict = {}
+
+            for i, name in enumerate(self.x_fields):
+                params_dict[name] = {"MIN": self.norm_params[-1][0][0][i], "MAX": self.norm_params[-1][1][0][i]}
+
+            with open("norm_params", "wb") as file:
+                pickle.dump(params_dict, file)
+
+    @staticmethod
+    def load_state(state_path, table, db_x_query, chunk_size, window):
+        """Returns the persisted chunk statistics, or None when there are none
+        or they were computed for another table, query or chunk layout."""
+        try:
+            with open(state_path, "rb") as file:
+                state = pickle.load(file)
+        except FileNotFoundError:
+            return None
+
+        if (state["table"], state["db_x_query"], state["chunk_size"], state["window"]) != \
+                (table, db_x_query, chunk_size, window):
+            return None
+        if state["seg_min"].shape[1] != SEGMENTS:
+            return None
+        return state
+
+    @staticmethod
+    def save_state(state_path, state):
+        tmp_path = "{}.tmp".format(state_path)
+        with open(tmp_path, "wb") as file:
+            pickle.dump(state, file)
+        os.replace(tmp_path, state_path)
+
+    def cached_norm_params(self, cache, stats, cursor, table, db_x_query, db_length):
+        """Reads the norm params of complete chunks from `cache` and only
+        computes the chunks from the first missing one onwards, usually just
+        the newest, still-growing chunk."""
+        schema = schema_hash(cursor, table)
+        keys = [cache.key(table, db_x_query, chunk_range.start, chunk_range.stop, schema)
+                for chunk_range in self.chunk_indices]
+
+        cached = [cache.load(key, ("x_min", "x_max")) for key in keys[:-1]]
+        first_missing = next((chunk for chunk, entry in enumerate(cached) if entry is None), self.num_chunks)
+        start_id = 1 if first_missing == 0 else self.chunk_indices[first_missing].start
+
+        computed = stats.norm_params(*stats.compute_segments(cursor, db_length, start_id))
+
+        norm_params = []
+        for chunk, key in enumerate(keys):
+            if chunk < first_missing:
+                norm_params.append((torch.tensor(cached[chunk]["x_min"]), torch.tensor(cached[chunk]["x_max"])))
+                continue
+
+            x_min, x_max = computed[chunk]
+            if chunk < self.num_chunks:
+                cache.store(key, x_min=x_min.numpy(), x_max=x_max.numpy())
+            norm_params.append((x_min, x_max))
+
+        return norm_params
 
     def __getitem__(self, idx):
         return tuple(self.chunk_indices[idx]), self.norm_params[idx]
@@ -104,44 +147,161 @@ class MySQLChunkLoader(Dataset):
     def __len__(self):
         return self.num_chunks + 1
     
+def unbuffered_cursor(cursor):
+    """Returns a server-side cursor on the connection of `cursor` so rows are
+    streamed instead of buffered on the client, or `cursor` itself when the
+    driver does not provide one."""
+    connection = getattr(cursor, "connection", None)
+    module = type(cursor).__module__
+
+    try:
+        if module.startswith("pymysql"):
+            from pymysql.cursors import SSCursor
+        elif module.startswith("MySQLdb"):
+            from MySQLdb.cursors import SSCursor
+        else:
+            return cursor
+    except ImportError:
+        return cursor
+
+    if connection is None:
+        return cursor
+    return connection.cursor(SSCursor)
+
+SQL_CLAUSES = ("JOIN", "INNER", "LEFT", "RIGHT", "CROSS", "NATURAL", "STRAIGHT_JOIN", "WHERE", "GROUP", "ORDER", "LIMIT")
+
+def first_table_id(from_statement):
+    tokens = from_statement.split()
+    table = tokens[1]
+    if len(tokens) > 2 and tokens[2].upper() == "AS":
+        return "{}.ID".format(tokens[3])
+    if len(tokens) > 2 and tokens[2].upper() not in SQL_CLAUSES:
+        return "{}.ID".format(tokens[2])
+    return "{}.ID".format(table)
+
+def fetch_into_buffers(cursor, num_rows, widths, fetch_size=10000):
+    """Streams the result set of `cursor` with fetchmany into preallocated
+    float32 buffers, one per group of columns of the given widths."""
+    buffers = [np.empty((num_rows, width), dtype=np.float32) for width in widths]
+    bounds = np.cumsum((0,) + tuple(widths))
+    filled = 0
+
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+
+        rows = np.array(rows, dtype=np.float32)
+        for buffer, lo, hi in zip(buffers, bounds[:-1], bounds[1:]):
+            buffer[filled:filled + len(rows)] = rows[:, lo:hi]
+        filled += len(rows)
+
+    return [buffer[:filled] for buffer in buffers]
+
 class MySQLBatchLoader(Dataset):
-    def __init__(self, indices, norm_params, cursor, table, db_x_query, y_fields, window):
+    def __init__(self, indices, norm_params, cursor, table, db_x_query, y_fields, window, fetch_mode='in',
+                 fetch_size=10000, cache=None):
 
         super(MySQLBatchLoader,self).__init__()
 
+        assert (fetch_mode == 'in' or fetch_mode == 'range'), '{} fetch mode is not supported'.format(fetch_mode)
+
         indices = tuple(indices)
 
-        db_x_query = [w.strip(",") for w in db_x_query.split()]
-        fields_start_idx = db_x_query.index("SELECT")
-        fields_end_idx = db_x_query.index("FROM")
-        x_fields = db_x_query[fields_start_idx + 1: fields_end_idx]
+        with borrowed_cursor(cursor) as cursor:
+
+            if cache is not None:
+                key = cache.key(table, db_x_query, y_fields, indices[0], indices[-1], len(indices),
+                                schema_hash(cursor, table, "target"),
+                                norm_params[0].numpy(), norm_params[1].numpy())
+                entry = cache.load(key, ("x", "y"))
+            else:
+                entry = None
+
+            if entry is not None:
+                self.x = torch.from_numpy(entry["x"])
+                self.y = torch.from_numpy(entry["y"])
+            else:
+                self.x, self.y = self.fetch(indices, norm_params, cursor, db_x_query, y_fields, fetch_mode, fetch_size)
+
+                if cache is not None:
+                    cache.store(key, x=self.x.numpy(), y=self.y.numpy())
+
+        self.window = window
+
+        if len(self.x) < window:
+            self.windows = self.x.new_empty((0, window, self.x.shape[1] if self.x.dim() == 2 else 0))
+        else:
+            self.windows = self.x.unfold(0, window, 1).transpose(1, 2)
+
+    @staticmethod
+    def fetch(indices, norm_params, cursor, db_x_query, y_fields, fetch_mode, fetch_size):
+        x_fields, from_statement = parse_x_query(db_x_query)
         x_fields_not_null = ",".join("IFNULL({}, 0)".format(field) for field in x_fields).strip(", ")
 
-        from_start_idx = db_x_query.index("FROM")
-        from_statement = " ".join(db_x_query[from_start_idx]).strip(";")
+        if fetch_mode == 'in':
+            cursor.execute("SELECT {} {} WHERE ID IN {};"\
+                    .format(x_fields_not_null, from_statement, indices))
+            
+            x = torch.Tensor(cursor.fetchall())
 
-        cursor.execute("SELECT {} {} WHERE ID IN {};"\
-                .format(x_fields_not_null, from_statement, indices))
-        
-        self.x = torch.Tensor(cursor.fetchall())
+            cursor.execute("SELECT {} FROM target WHERE ID IN {};"\
+                    .format(y_fields, indices))
+            
+            y = torch.Tensor(cursor.fetchall())
 
-        cursor.execute("SELECT {} FROM target WHERE ID IN {};"\
-                .format(y_fields, indices))
-        
-        self.y = torch.Tensor(cursor.fetchall())
+            x = (x - norm_params[0][0])/(norm_params[1][0] - norm_params[0][0])
+
+            return x, y
+
+        x_id = first_table_id(from_statement)
+        y_fields = [field.strip() for field in y_fields.split(",")]
+        y_fields_target = ", ".join("target.{}".format(field) for field in y_fields)
 
-        self.x = (self.x - norm_params[0][0])/(norm_params[1][0] - norm_params[0][0])
+        stream = unbuffered_cursor(cursor)
+        stream.execute("SELECT {x}, {y} {from_statement} JOIN target ON target.ID = {x_id} "
+                       "WHERE {x_id} BETWEEN {lo} AND {hi} ORDER BY {x_id};"
+                       .format(x=x_fields_not_null, y=y_fields_target, from_statement=from_statement,
+                               x_id=x_id, lo=indices[0], hi=indices[-1]))
 
-        self.indices_gen = window_indices(range(len(indices)), window)
+        x, y = fetch_into_buffers(stream, len(indices), (len(x_fields), len(y_fields)), fetch_size)
+
+        if stream is not cursor:
+            stream.close()
+
+        x -= norm_params[0][0].numpy()
+        x /= (norm_params[1][0] - norm_params[0][0]).numpy()
+
+        return torch.from_numpy(x), torch.from_numpy(y)
 
     def __getitem__(self, idx):
-        indices = next(self.indices_gen)
-        return self.x[[indices]], self.y[[indices[-1]]]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('Window {} is out of range'.format(idx))
+        return self.windows[idx], self.y[idx + self.window - 1: idx + self.window]
     
     def __len__(self):
-        return len(self.x)
+        return max(len(self.x) - self.window + 1, 0)
     
 
+class ChunkSplit:
+    """Lazy, re-iterable view over the chunks [start, end) of a chunk dataset,
+    yielding (indices, norm_params) pairs one chunk at a time."""
+    def __init__(self, dataset, start, end):
+        self.dataset = dataset
+        self.start = start
+        self.end = min(end, len(dataset))
+
+    def __iter__(self):
+        for idx in range(self.start, self.end):
+            indices, norm_params = self.dataset[idx:idx + 1]
+            yield indices[0], norm_params[0]
+
+    def __len__(self):
+        return max(self.end - self.start, 0)
+
+
 class TrainValTestSplit:
     def __init__(self, dataset, val_size=0.1, test_size=0.1):
 
@@ -157,24 +317,55 @@ class TrainValTestSplit:
 
     def get_train(self):
         self.train_end_idx = int(self.train_size * self.dataset_len)
-        train_set_ind = self.dataset[0:self.train_end_idx][0]
-        train_set_norms = self.dataset[0:self.train_end_idx][1]
-        return zip(train_set_ind, train_set_norms)
+        return ChunkSplit(self.dataset, 0, self.train_end_idx)
     
     def get_val(self):
         self.val_start_idx = self.train_end_idx
         self.val_end_idx = self.val_start_idx + int(self.val_size * self.dataset_len) + 1
-        val_set_ind = self.dataset[self.val_start_idx:self.val_end_idx][0]
-        val_set_norms = self.dataset[self.val_start_idx:self.val_end_idx][1]
-        return zip(val_set_ind, val_set_norms)
+        return ChunkSplit(self.dataset, self.val_start_idx, self.val_end_idx)
     
     def get_test(self):
         self.test_start_idx = self.val_end_idx 
         self.test_end_idx = self.test_start_idx + int(self.test_size * self.dataset_len) + 1
-        test_set_ind = self.dataset[self.test_start_idx:self.test_end_idx][0]
-        test_set_norms = self.dataset[self.test_start_idx:self.test_end_idx][1]
-        return zip(test_set_ind, test_set_norms)
+        return ChunkSplit(self.dataset, self.test_start_idx, self.test_end_idx)
     
     def get_sets(self):
         return self.get_train(), self.get_val(), self.get_test()
-    
\ No newline at end of file
+
+    def walk_forward(self, train_chunks, test_chunks, val_chunks=0, step=None, mode='expanding'):
+        """Yields (train, val, test) ChunkSplit folds for walk-forward validation.
+
+        Parameters
+        ----------
+        train_chunks: int
+        Number of training chunks of the first fold, and of every fold in
+        'rolling' mode
+        test_chunks: int
+        Number of test chunks of every fold
+        val_chunks: int
+        Number of validation chunks between the training and test chunks
+        step: int
+        Number of chunks the folds move forward by, test_chunks by default
+        mode: str
+        'expanding' keeps the training start at the first chunk, 'rolling'
+        moves it forward with the fold
+        """
+        assert mode in ('expanding', 'rolling'), '{} mode is not supported'.format(mode)
+        assert train_chunks > 0 and test_chunks > 0 and val_chunks >= 0, 'Fold sizes must be positive'
+
+        step = step or test_chunks
+        offset = 0
+
+        while True:
+            train_start = offset if mode == 'rolling' else 0
+            train_end = offset + train_chunks
+            val_end = train_end + val_chunks
+            test_end = val_end + test_chunks
+
+            if test_end > self.dataset_len:
+                return
+
+            yield ChunkSplit(self.dataset, train_start, train_end), ChunkSplit(self.dataset, train_end, val_end), \
+                ChunkSplit(self.dataset, val_end, test_end)
+
+            offset += step
@@ -0,0 +1,158 @@
+"""Throughput benchmark of the dataloader stack against a synthetic SQLite
+tick table laid out like the production one (sd.bid_N_size/sd.ask_N_size).
+
+    python dataloader_benchmark.py --rows 200000 --chunk-sizes 5000 20000 --windows 10 50 --output bench.json
+"""
+import os
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import datetime
+import numpy as np
+from torch.utils.data import DataLoader
+from dataloader import MySQLChunkLoader, MySQLBatchLoader, parse_x_query
+from chunk_stats import ChunkStatistics
+from orderbook import OrderBookLayout
+
+
+def make_tick_table(con, rows, levels, seed=0):
+    rng = np.random.default_rng(seed)
+    cursor = con.cursor()
+
+    book_fields = ["bid_{}_size".format(i) for i in range(levels)] + ["ask_{}_size".format(i) for i in range(levels)]
+    fields = ["price"] + book_fields
+
+    cursor.execute("DROP TABLE IF EXISTS ticks;")
+    cursor.execute("DROP TABLE IF EXISTS target;")
+    cursor.execute("CREATE TABLE ticks (ID INTEGER PRIMARY KEY, {});"
+                   .format(", ".join("{} REAL".format(f) for f in fields)))
+    cursor.execute("CREATE TABLE target (ID INTEGER PRIMARY KEY, y REAL);")
+
+    batch = 50000
+    for lo in range(1, rows + 1, batch):
+        ids = np.arange(lo, min(lo + batch, rows + 1))
+        price = 100 + np.cumsum(rng.normal(scale=0.01, size=len(ids)))
+        sizes = rng.integers(1, 1000, size=(len(ids), len(book_fields))).astype(np.float64)
+
+        cursor.executemany("INSERT INTO ticks VALUES ({});".format(", ".join("?" * (len(fields) + 1))),
+                           np.column_stack([ids, price, sizes]).tolist())
+        direction = np.sign(np.diff(price, prepend=price[0]))
+        cursor.executemany("INSERT INTO target VALUES (?, ?);", np.column_stack([ids, direction]).tolist())
+
+    con.commit()
+
+    return "SELECT {} FROM ticks sd;".format(", ".join("sd.{}".format(f) for f in fields))
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_setting(cursor, db_x_query, rows, levels, chunk_size, window, fetch_chunks, batch_size):
+    result = {'rows': rows, 'levels': levels, 'chunk_size': chunk_size, 'window': window}
+
+    x_fields, from_statement = parse_x_query(db_x_query)
+
+    for method in ('grouped', 'scan'):
+        stats = ChunkStatistics(x_fields, from_statement, chunk_size, window, method=method)
+        _, seconds = timed(stats.compute, cursor, rows)
+        result['stats_{}_s'.format(method)] = seconds
+        result['stats_{}_rows_per_s'.format(method)] = rows / seconds
+
+    chunks, seconds = timed(MySQLChunkLoader, cursor, 'ticks', db_x_query, chunk_size, window, bid_levels=levels,
+                            ask_levels=levels)
+    result['construction_s'] = seconds
+
+    layout = OrderBookLayout(x_fields, levels, levels)
+    _, seconds = timed(layout.pool_norm_params, chunks.norm_params)
+    result['book_normalization_s'] = seconds
+
+    selected = range(min(fetch_chunks, len(chunks) - 1))
+    for fetch_mode in ('in', 'range'):
+        fetched_rows, seconds = 0, 0.0
+        for idx in selected:
+            indices, norm_params = chunks[idx]
+            batch, elapsed = timed(MySQLBatchLoader, indices, norm_params, cursor, 'ticks', db_x_query, 'y', window,
+                                   fetch_mode=fetch_mode)
+            fetched_rows += len(batch.x)
+            seconds += elapsed
+        result['fetch_{}_s'.format(fetch_mode)] = seconds
+        result['fetch_{}_rows_per_s'.format(fetch_mode)] = fetched_rows / seconds if seconds else None
+
+    indices, norm_params = chunks[0]
+    batch = MySQLBatchLoader(indices, norm_params, cursor, 'ticks', db_x_query, 'y', window, fetch_mode='range')
+
+    def index_all():
+        for idx in range(len(batch)):
+            batch[idx]
+
+    _, seconds = timed(index_all)
+    result['windows_per_s'] = len(batch) / seconds
+
+    def iterate_batches():
+        for _ in DataLoader(batch, batch_size=batch_size, shuffle=True):
+            pass
+
+    _, seconds = timed(iterate_batches)
+    result['shuffled_batches_windows_per_s'] = len(batch) / seconds
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--levels', type=int, default=10)
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[5000, 20000])
+    parser.add_argument('--windows', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--fetch-chunks', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--database', default=None, help='SQLite file, a temporary one by default')
+    parser.add_argument('--output', default='dataloader_benchmark.json')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='dataloader-bench-')
+    database = os.path.abspath(args.database) if args.database else os.path.join(workdir, 'ticks.sqlite')
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd()
+
+    try:
+        con = sqlite3.connect(database)
+        db_x_query, seconds = timed(make_tick_table, con, args.rows, args.levels)
+        print('Generated {} rows in {:.2f}s'.format(args.rows, seconds))
+
+        # MySQLChunkLoader writes its norm_params file to the working directory
+        os.chdir(workdir)
+
+        results = []
+        for chunk_size in args.chunk_sizes:
+            for window in args.windows:
+                result = bench_setting(con.cursor(), db_x_query, args.rows, args.levels, chunk_size, window,
+                                       args.fetch_chunks, args.batch_size)
+                print(json.dumps(result))
+                results.append(result)
+
+        con.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+              'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version,
+              'results': results}
+
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    print('Results written to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
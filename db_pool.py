@@ -0,0 +1,126 @@
+import os
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """Thread-safe pool of database connections the dataloaders borrow
+    cursors from, so chunks can be fetched concurrently.
+
+    Connections are never shared across processes: a forked DataLoader worker
+    starts with an empty pool and opens its own connections, and the pool
+    can be pickled to spawned workers without its connections.
+
+    Parameters
+    ----------
+    connect: callable
+    Returns a new DB-API connection, e.g. functools.partial(pymysql.connect, ...)
+    size: int
+    Maximum number of open connections per process
+    timeout: float
+    Seconds to wait for a free connection before raising queue.Empty
+    """
+    def __init__(self, connect, size=8, timeout=None):
+
+        assert size >= 1, 'Pool size must be at least 1'
+
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.idle = queue.LifoQueue(maxsize=self.size)
+        self.opened = 0
+
+    def __getstate__(self):
+        return {'connect': self.connect, 'size': self.size, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset()
+
+    def acquire(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+
+        if can_open:
+            try:
+                return self.connect()
+            except Exception:
+                with self.lock:
+                    self.opened -= 1
+                raise
+
+        return self.idle.get(timeout=self.timeout)
+
+    def release(self, connection):
+        if self.pid != os.getpid():
+            return
+        self.idle.put_nowait(connection)
+
+    def discard(self, connection):
+        if self.pid == os.getpid():
+            with self.lock:
+                self.opened -= 1
+        try:
+            connection.close()
+        except Exception as msg:
+            logging.warning('Failed to close a pooled connection: {}'.format(msg))
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        except Exception:
+            self.discard(connection)
+            raise
+        else:
+            self.release(connection)
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+    def worker_init_fn(self, worker_id):
+        """torch DataLoader worker_init_fn giving every worker its own connections."""
+        self.reset()
+
+
+@contextmanager
+def borrowed_cursor(source):
+    """Yields a cursor borrowed from `source` when it is a ConnectionPool, or
+    `source` itself when it is already a cursor."""
+    if isinstance(source, ConnectionPool):
+        with source.cursor() as cursor:
+            yield cursor
+    else:
+        yield source
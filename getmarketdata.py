@@ -1,169 +1,298 @@
 import requests 
+import threading 
 import json 
+import numpy as np 
 import pandas as pd 
 import io 
 import datetime 
 import logging 
+from concurrent.futures import ThreadPoolExecutor
 from config import time_zone
+from response_cache import default_response_cache
+from book_snapshot import OrderBookSnapshot
+from latency import default_recorder
 
-def change_keys(obj, old, new):
-    if isinstance(obj, dict):
-        new_obj = obj.__class__()
-        for k, v in obj.items():
-            new_obj[k.replace(old, new)] = change_keys(v, old, new)
-    elif isinstance(obj, (list, set, tuple)):
-        new_obj = obj.__class__(change_keys(v, old, new) for v in obj)
-    else:
-        return obj 
-    
-    return new_obj
+class ThrottledError(Exception):
+    """Raised when Alpha Vantage answers with a rate-limit notice or an empty
+    body instead of data."""
 
-def to_number(v):
-    try:
-        if v.isdigit():
-            return int(v)
-        else:
-            return float(v)
-    except ValueError:
-        return v
-    
-def value_to_number(obj):
+
+def is_throttled(content):
+    return not content or b'"Note"' in content or b'"Information"' in content
+
+
+def normalize(obj, old='.', new='_'):
+    """Renames keys and converts numeric strings in a single traversal."""
+    if isinstance(obj, str):
+        if obj.isdigit():
+            return int(obj)
+        try:
+            return float(obj)
+        except ValueError:
+            return obj
     if isinstance(obj, dict):
         new_obj = obj.__class__()
         for k, v in obj.items():
-            if isinstance(v, dict):
-                new_obj[k] = value_to_number(v)
-            elif isinstance(v, (list, set, tuple)):
-                new_obj[k] = v.__class__(to_number(lv) for lv in v)
-            else:
-                new_obj[k] = to_number(v)
+            new_obj[k.replace(old, new) if isinstance(k, str) else k] = normalize(v, old, new)
+        return new_obj
+    if isinstance(obj, (list, set, tuple)):
+        return obj.__class__(normalize(v, old, new) for v in obj)
+    return obj
 
-    elif isinstance(obj, (list, set, tuple)):
-        new_obj = obj.__class__(value_to_number(lv) for lv in obj)
-    else:
-        return obj 
-    
-    return new_obj 
+def time_series_key(payload):
+    return next(key for key in payload if key.startswith('Time Series'))
+
+def time_series_columns(series):
+    raw_columns = list(next(iter(series.values())))
+    return raw_columns, [column.split('. ', 1)[-1].replace(' ', '_') for column in raw_columns]
+
+def time_series_arrays(payload):
+    """Converts a raw Alpha Vantage time-series payload, e.g. a full
+    TIME_SERIES_INTRADAY response, into (timestamps, values, columns) with
+    datetime64 timestamps and one float64 row per bar, newest first."""
+    series = payload[time_series_key(payload)]
+    raw_columns, columns = time_series_columns(series)
+
+    timestamps = np.array(list(series.keys()), dtype='datetime64[s]')
+    values = np.array([[bar[column] for column in raw_columns] for bar in series.values()], dtype=np.float64)
+
+    return timestamps, values, columns
+
+def time_series_records(payload):
+    """Converts a raw Alpha Vantage time-series payload into flat records
+    {'Timestamp': ..., 'open': ..., ...} with numeric values, newest first."""
+    series = payload[time_series_key(payload)]
+    raw_columns, columns = time_series_columns(series)
+
+    return [dict(zip(columns, map(float, (bar[column] for column in raw_columns))), Timestamp=dt)
+            for dt, bar in series.items()]
+
+
+def read_csv_bytes(content, nrows=None):
+    """Parses a CSV response body straight from its bytes, without decoding
+    it to a str first. With `nrows` the parser stops after the first rows."""
+    return pd.read_csv(io.BytesIO(content), nrows=nrows)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_default_session = None
+
+def set_default_session(session):
+    """Makes GetData and get_market_calendar use `session` when none is
+    given, e.g. a RecordingSession or ReplaySession. None restores the pooled
+    sessions."""
+    global _default_session
+    _default_session = session
+
+def get_session(pool_size=10, max_retries=0):
+    """Returns the process-wide keep-alive session for the given pool size,
+    so DNS, TCP and TLS setup are paid once per host instead of per request."""
+    if _default_session is not None:
+        return _default_session
+
+    key = (pool_size, max_retries)
+    with _sessions_lock:
+        if key not in _sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                                    max_retries=max_retries)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[key] = session
+        return _sessions[key]
 
 
 class GetData:
-    def __init__(self, token, output_format='json'):
+    def __init__(self, token, output_format='json', session=None, pool_size=10, timeout=(3.05, 30), cache=None,
+                 book_format='dict'):
 
         self.__token = token 
         self.output_format = output_format
+        self.session = session or get_session(pool_size)
+        self.timeout = timeout
+        self.cache = cache or default_response_cache
+        self.book_format = book_format
 
         assert (output_format == 'json' or output_format == 'csv'), '{} format is not supported'\
             .format(output_format)
+        assert (book_format == 'dict' or book_format == 'array'), '{} book format is not supported'\
+            .format(book_format)
         
+    def iex_url(self, request, output_format=None):
+        return 'https://cloud.iexapis.com/v1{request}token={token}&format={output_format}'\
+            .format(request=request, token=self.__token['iex_token'], output_format=output_format or self.output_format)
+
+    def fetch(self, url, endpoint, interval=None, acquire=None):
+        """Returns the response body of `url`, served from the response cache
+        while the endpoint's TTL has not expired. `acquire`, when given, is
+        called with `url` only when the request is actually sent, and returns
+        the URL to send it to."""
+        def request():
+            send_url = url if acquire is None else acquire(url)
+            with default_recorder.span('fetch'):
+                req = self.session.get(send_url, timeout=self.timeout)
+            cacheable = req.status_code == 200 and bool(req.content)
+            if endpoint == 'av':
+                cacheable = cacheable and b'Error Message' not in req.content and not is_throttled(req.content)
+            return req.content, cacheable
+
+        return self.cache.get(endpoint, url, request, interval)
+
     def get_iex_data(self, request, timestamp):
-        self.url = 'https://cloud.iexapis.com/v1{request}token={token}&format={output_format}'\
-            .format(request=request, token=self.__token['iex_token'], output_format=self.output_format)
+        self.url = self.iex_url(request)
         
         try:
-            req = requests.get(self.url)
+            content = self.fetch(self.url, 'iex')
 
-            if self.output_format == 'json':
-                raw_data = json.loads(req.content)
-            else:
-                raw_data = pd.read_csv(io.StringIO(req.content.decode('utf-8')))
+            with default_recorder.span('normalize'):
+                if self.output_format == 'json':
+                    raw_data = json.loads(content)
+                else:
+                    raw_data = read_csv_bytes(content)
 
-            if isinstance(raw_data, dict):
-                raw_data['Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
+                if isinstance(raw_data, dict):
+                    raw_data['Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
 
-                if '/deep/book' in request:
-                    symbol = list(raw_data.keys())[0]
+                    if '/deep/book' in request:
+                        symbol = list(raw_data.keys())[0]
 
-                    for i, level in enumerate(raw_data[symbol]['bids']):
-                        raw_data['bids_{:d}'.format(i)] = {'bid_{:d}'.format(i): level['price'],
-                                                           'bid_{:d}_size'.format(i): level['size']}
+                        if self.book_format == 'array':
+                            return OrderBookSnapshot.from_iex(symbol, raw_data[symbol], raw_data['Timestamp'])
+
+                        for i, level in enumerate(raw_data[symbol]['bids']):
+                            raw_data['bids_{:d}'.format(i)] = {'bid_{:d}'.format(i): level['price'],
+                                                               'bid_{:d}_size'.format(i): level['size']}
                         
-                    for i, level in enumerate(raw_data[symbol]['asks']):
-                        raw_data['asks_{:d}'.format(i)] = {'ask_{:d}'.format(i): level['price'],
-                                                           'ask_{:d}_size'.format(i): level['size']}
+                        for i, level in enumerate(raw_data[symbol]['asks']):
+                            raw_data['asks_{:d}'.format(i)] = {'ask_{:d}'.format(i): level['price'],
+                                                               'ask_{:d}_size'.format(i): level['size']}
                         
-                    del raw_data[symbol]
+                        del raw_data[symbol]
 
-            if isinstance(raw_data, list):
-                for mssg in raw_data:
-                    mssg['Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
+                if isinstance(raw_data, list):
+                    for mssg in raw_data:
+                        mssg['Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
 
-        except requests.exceptions.ConnectionError as mssg:
-            print(mssg)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as mssg:
+            logging.warning('IEX request failed: {}'.format(mssg))
+            return None
 
         return raw_data 
 
+    def get_iex_batch(self, symbols, timestamp, types='quote', batch_size=100, max_workers=8, params=''):
+        """Fetches `types` for many symbols through the IEX batch endpoint,
+        packing up to `batch_size` symbols per request and sending at most
+        `max_workers` requests at once. Returns one dict keyed by symbol with
+        a single Timestamp."""
+        assert batch_size <= 100, 'IEX batch requests are limited to 100 symbols'
+
+        symbols = list(symbols)
+        requests_list = ['/stock/market/batch?symbols={symbols}&types={types}&{params}'\
+            .format(symbols=','.join(symbols[i:i + batch_size]), types=types, params=params + '&' if params else '')
+            for i in range(0, len(symbols), batch_size)]
+
+        def fetch(request):
+            try:
+                with default_recorder.span('fetch'):
+                    req = self.session.get(self.iex_url(request, 'json'), timeout=self.timeout)
+                req.raise_for_status()
+                with default_recorder.span('normalize'):
+                    return json.loads(req.content)
+            except requests.exceptions.RequestException as mssg:
+                logging.warning('IEX batch request failed: {}'.format(mssg))
+                return {}
+
+        raw_data = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch in executor.map(fetch, requests_list):
+                raw_data.update(batch)
+
+        raw_data['Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
 
-def get_av_data(self, timestamp, function=None, symbol=None, interval=None, request=None):
-    if not request:
-        if function in ['FX_INTRADAY', 'FX_DAILY', 'FX_WEEKLY', 'FX_MONTHLY']:
-            symbol1, symbol2 = symbol[:3], symbol[3:]
-            self.url = 'https://www.alphavantage.co/query?function={function}&from_symbol={symbol1}'\
-                '&to_symbol={symbol2}&interval={interval}&apikey={token}&datatype={output_format}'\
-                .format(function=function, symbol1=symbol1, symbol2=symbol2, interval=interval, \
-                        token=self.__token['av_token'], output_format=self.output_format)
+        return raw_data
+
+
+    def get_av_data(self, timestamp, function=None, symbol=None, interval=None, request=None, acquire=None):
+        if not request:
+            if function in ['FX_INTRADAY', 'FX_DAILY', 'FX_WEEKLY', 'FX_MONTHLY']:
+                symbol1, symbol2 = symbol[:3], symbol[3:]
+                self.url = 'https://www.alphavantage.co/query?function={function}&from_symbol={symbol1}'\
+                    '&to_symbol={symbol2}&interval={interval}&apikey={token}&datatype={output_format}'\
+                    .format(function=function, symbol1=symbol1, symbol2=symbol2, interval=interval, \
+                            token=self.__token['av_token'], output_format=self.output_format)
 
+            else:
+                self.url = 'https://www.alphavantage.co/query?function={function}&symbol={symbol}'\
+                    '&interval={interval}&apikey={token}&datatype={output_format}'\
+                    .format(function=function, symbol=symbol, interval=interval, token=self.__token['av_token'],\
+                            output_format=self.output_format)
         else:
-            self.url = 'https://www.alphavantage.co/query?function={function}&symbol={symbol}'\
-                '&interval={interval}&apikey={token}&datatype={output_format}'\
-                .format(function=function, symbol=symbol, interval=interval, token=self.__token['av_token'],\
-                        output_format=self.output_format)
-    else:
-        self.url = 'https://www.alphavntage.co/query?' + request + '&apikey={token}&datatype={output_format}'\
-            .format(token=self.__token['av_token'], output_format=self.output_format)
+            self.url = 'https://www.alphavntage.co/query?' + request + '&apikey={token}&datatype={output_format}'\
+                .format(token=self.__token['av_token'], output_format=self.output_format)
         
-    try:
-        req = requests.get(self.url)
-        if self.output_format == 'json':
-            raw_data = json.loads(req.content)
+        try:
+            content = self.fetch(self.url, 'av', interval, acquire)
+            if is_throttled(content):
+                raise ThrottledError(content[:200].decode('utf-8', 'replace') or 'Empty Alpha Vantage response')
+            with default_recorder.span('normalize'):
+                if self.output_format == 'json':
+                    raw_data = json.loads(content)
 
-            if not raw_data:
-                raise Exception('Alpha advantage API isnt available')
+                    if not raw_data:
+                        raise Exception('Alpha advantage API isnt available')
             
-            if 'Error message' in raw_data:
-                raise Exception(raw_data['Error message'])
+                    if 'Error message' in raw_data:
+                        raise Exception(raw_data['Error message'])
             
-            keys_level_1 = list(raw_data.keys())
-            last_dt_str = list(raw_data[keys_level_1[1]].keys())[0]
+                    keys_level_1 = list(raw_data.keys())
+                    last_dt_str = list(raw_data[keys_level_1[1]].keys())[0]
 
-            last_dt = datetime.datetime.strptime(last_dt_str, "%Y-%m-%d %H:%M:%S")
-            last_dt = time_zone['EST'].localize(last_dt)
+                    last_dt = datetime.datetime.strptime(last_dt_str, "%Y-%m-%d %H:%M:%S")
+                    last_dt = time_zone['EST'].localize(last_dt)
 
-            raw_data = raw_data[keys_level_1[1]][last_dt_str]
+                    raw_data = raw_data[keys_level_1[1]][last_dt_str]
 
-            if last_dt < timestamp - datetime.timedelta(minutes=4):
-                logging.warning('RETURNED DATA IS DELAYED')
-                raw_data['Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
-            else:
-                raw_data['Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
+                    if last_dt < timestamp - datetime.timedelta(minutes=4):
+                        logging.warning('RETURNED DATA IS DELAYED')
+                        raw_data['Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
+                    else:
+                        raw_data['Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
 
-        else:
-            raw_data = pd.read_csv(io.StringIO(req.content.decode('utf-8')))
+                else:
+                    raw_data = read_csv_bytes(content, nrows=1)
 
-            if 'Error message' in raw_data.iloc[0, 0]:
-                raise Exception(raw_data.iloc[0, 0])
+                    if 'Error message' in raw_data.iloc[0, 0]:
+                        raise Exception(raw_data.iloc[0, 0])
             
-            raw_data = raw_data.iloc[0:1, :]
-            last_dt_str = raw_data.loc[0, 'Timestamp']
-            last_dt = datetime.datetime.strptime(last_dt_str, "%Y-%m-%d %H:%M:%S")
-            last_dt = time_zone['EST'].localize(last_dt)
-
-            if last_dt < timestamp - datetime.timedelta(minutes=4):
-                logging.warning('RETURNED DATA IS DELAYED')
-                raw_data.iloc[0, 'Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
-            else:
-                raw_data.iloc[0, 'Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
+                    raw_data = raw_data.iloc[0:1, :]
+                    last_dt_str = raw_data.loc[0, 'Timestamp']
+                    last_dt = datetime.datetime.strptime(last_dt_str, "%Y-%m-%d %H:%M:%S")
+                    last_dt = time_zone['EST'].localize(last_dt)
 
-        raw_data = change_keys(raw_data, ".", "_")
+                    if last_dt < timestamp - datetime.timedelta(minutes=4):
+                        logging.warning('RETURNED DATA IS DELAYED')
+                        raw_data.iloc[0, 'Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
+                    else:
+                        raw_data.iloc[0, 'Timestamp'] = datetime.datetime.strftime(timestamp, "%Y-%m-%d %H:%M:%S")
 
-        raw_data = value_to_number(raw_data)
+                raw_data = normalize(raw_data, ".", "_")
 
-        return raw_data
+            return raw_data
     
-    except requests.exceptions.ConnectionError as msg:
-        print(msg)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as msg:
+            logging.warning('Alpha Vantage request failed: {}'.format(msg))
+            return None
+
+
+def get_market_calendar(session=None, timeout=(3.05, 30), cache=None):
+    session = session or get_session()
+    cache = cache or default_response_cache
+    url = 'https://capital.com/trading/platform/'
 
+    def request():
+        response = session.get(url, timeout=timeout,
+            headers={'Authorization': 'Bearer <TOKEN>', 'Accept': 'application/json'})
+        return response.content, response.status_code == 200
 
-def get_market_calendar():
-    response = requests.get('https://capital.com/trading/platform/',
-        headers={'Authorization': 'Bearer <TOKEN>', 'Accept': 'application/json'})
-    return response.json()['calendar']['days']['day']
+    return json.loads(cache.get('calendar', url, request))['calendar']['days']['day']
@@ -0,0 +1,192 @@
+import time
+import math
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """HDR-style latency histogram: values are counted in microseconds in
+    log2 buckets split into linear sub-buckets, so every recorded value is
+    kept within `significant_figures` digits of precision at a fixed memory
+    cost whatever the range.
+
+    Parameters
+    ----------
+    highest: float
+    Highest trackable latency in seconds, larger values being clamped
+    significant_figures: int
+    Number of significant decimal digits kept
+    """
+    def __init__(self, highest=3600.0, significant_figures=2):
+
+        self.highest = int(highest * 1e6)
+        self.sub_bucket_count = 2 ** int(math.ceil(math.log2(2 * 10 ** significant_figures)))
+        self.sub_bucket_half_count = self.sub_bucket_count // 2
+        self.sub_bucket_magnitude = int(math.log2(self.sub_bucket_count))
+        self.sub_bucket_half_magnitude = self.sub_bucket_magnitude - 1
+
+        buckets = max(self.highest.bit_length() - self.sub_bucket_magnitude, 0) + 1
+        self.counts = np.zeros((buckets + 1) * self.sub_bucket_half_count, dtype=np.int64)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        bucket = max(value.bit_length() - self.sub_bucket_magnitude, 0)
+        sub_bucket = value >> bucket
+        return (bucket << self.sub_bucket_half_magnitude) + sub_bucket
+
+    def value_at(self, index):
+        bucket = max((index >> self.sub_bucket_half_magnitude) - 1, 0)
+        sub_bucket = index - (bucket << self.sub_bucket_half_magnitude)
+        return ((sub_bucket + 1) << bucket) - 1
+
+    def record(self, seconds):
+        value = min(max(int(seconds * 1e6), 0), self.highest)
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """Latency in seconds under which `q` percent of the values fall."""
+        if not self.count:
+            return 0.0
+        rank = max(int(math.ceil(q / 100 * self.count)), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(self.value_at(index), self.max) / 1e6
+
+    def mean(self):
+        return self.total / self.count / 1e6 if self.count else 0.0
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def reset(self):
+        self.counts[:] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def summary(self, percentiles=PERCENTILES):
+        summary = {'count': self.count, 'mean': self.mean(), 'max': self.max / 1e6}
+        summary.update({'p{:g}'.format(q): self.percentile(q) for q in percentiles})
+        return summary
+
+
+class LatencyRecorder:
+    """Thread-safe set of latency histograms, one per ingest stage (fetch,
+    normalize, serialize, enqueue and delivery to Kafka or send to a local
+    sink, each spider...)."""
+    def __init__(self, highest=3600.0, significant_figures=2):
+
+        self.highest = highest
+        self.significant_figures = significant_figures
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram(self.highest, self.significant_figures)
+            histogram.record(seconds)
+
+    @contextmanager
+    def span(self, stage):
+        """Records the time spent in the with block under `stage`."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def summary(self):
+        with self.lock:
+            return {stage: histogram.summary() for stage, histogram in sorted(self.histograms.items())}
+
+    def log_line(self):
+        """One line with the count, p50, p99 and max of every stage, in
+        milliseconds."""
+        return ' | '.join('{} n={} p50={:.1f}ms p99={:.1f}ms max={:.1f}ms'.format(
+            stage, s['count'], s['p50'] * 1e3, s['p99'] * 1e3, s['max'] * 1e3) for stage, s in self.summary().items())
+
+    def log_stats(self, timestamp=None):
+        line = self.log_line()
+        if line:
+            logging.warning('Stage latencies: {}'.format(line))
+
+    def reset(self):
+        with self.lock:
+            for histogram in self.histograms.values():
+                histogram.reset()
+
+
+default_recorder = LatencyRecorder()
+
+
+class MetricsServer:
+    """Local HTTP endpoint serving the summaries of a LatencyRecorder, as
+    JSON on /metrics.json and in the Prometheus text format on /metrics.
+
+    Parameters
+    ----------
+    recorder: LatencyRecorder
+    Recorder whose histograms are served
+    port: int
+    Port listened to on `host`
+    """
+    def __init__(self, recorder=None, port=9102, host='127.0.0.1'):
+
+        recorder = recorder or default_recorder
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics.json':
+                    body, content_type = json.dumps(recorder.summary()).encode('utf-8'), 'application/json'
+                elif self.path == '/metrics':
+                    body, content_type = prometheus_text(recorder.summary()).encode('utf-8'), 'text/plain'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.recorder = recorder
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def prometheus_text(summary):
+    lines = ['# TYPE ingest_stage_seconds summary']
+    for stage, s in summary.items():
+        for q in PERCENTILES:
+            lines.append('ingest_stage_seconds{{stage="{}",quantile="{:g}"}} {}'.format(stage, q / 100,
+                                                                                     s['p{:g}'.format(q)]))
+        lines.append('ingest_stage_seconds_sum{{stage="{}"}} {}'.format(stage, s['mean'] * s['count']))
+        lines.append('ingest_stage_seconds_count{{stage="{}"}} {}'.format(stage, s['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,56 @@
+import torch
+
+BID, ASK = 0, 1
+
+
+class OrderBookLayout:
+    """Maps the order-book size fields of an X query to a (T, levels, side)
+    layout, side 0 being the bids and side 1 the asks.
+
+    Parameters
+    ----------
+    x_fields: list
+    Fields selected by the X query
+    bid_levels: int
+    Number of bid levels
+    ask_levels: int
+    Number of ask levels
+    prefix: str
+    Table alias prepended to the field names
+    """
+    def __init__(self, x_fields, bid_levels, ask_levels, prefix="sd."):
+
+        self.x_fields = x_fields
+        self.levels = max(bid_levels, ask_levels)
+
+        positions = {name: i for i, name in enumerate(x_fields)}
+        missing = len(x_fields)
+
+        index = torch.full((self.levels, 2), missing, dtype=torch.long)
+        for level in range(bid_levels):
+            index[level, BID] = positions.get("{}bid_{}_size".format(prefix, level), missing)
+        for level in range(ask_levels):
+            index[level, ASK] = positions.get("{}ask_{}_size".format(prefix, level), missing)
+
+        self.index = index
+        self.present = index != missing
+        self.side_idx = [index[:, side][self.present[:, side]] for side in (BID, ASK)]
+
+    def pool_norm_params(self, norm_params):
+        """Shares one MIN/MAX per side across all book levels, for every chunk
+        at once. Takes and returns a norm_params list of (x_min, x_max)."""
+        x_min = torch.cat([chunk_min for chunk_min, _ in norm_params])
+        x_max = torch.cat([chunk_max for _, chunk_max in norm_params])
+
+        for idx in self.side_idx:
+            if len(idx):
+                x_min[:, idx] = x_min[:, idx].min(dim=1, keepdim=True).values
+                x_max[:, idx] = x_max[:, idx].max(dim=1, keepdim=True).values
+
+        return list(zip(x_min.split(1), x_max.split(1)))
+
+    def book(self, x):
+        """Gathers the size columns of x (T, fields) into a (T, levels, side)
+        tensor, levels absent from the query being zero."""
+        padded = torch.cat([x, x.new_zeros(len(x), 1)], dim=1)
+        return padded[:, self.index]
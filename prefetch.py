@@ -0,0 +1,122 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def dataset_nbytes(dataset):
+    """Bytes held by the x/y tensors of a loaded chunk dataset."""
+    return sum(tensor.element_size() * tensor.nelement()
+               for tensor in (getattr(dataset, 'x', None), getattr(dataset, 'y', None)) if tensor is not None)
+
+
+class ChunkPrefetcher:
+    """Iterates the chunk datasets of a split while the following chunks are
+    loaded in the background, so SQL and training overlap.
+
+    Parameters
+    ----------
+    chunks: iterable
+    (indices, norm_params) pairs, e.g. TrainValTestSplit.get_train()
+    load_fn: callable
+    Builds the dataset of one chunk from (indices, norm_params). With more
+    than one worker it must not share a cursor between calls
+    depth: int
+    Maximum number of chunks loaded ahead of the consumer
+    memory_budget: int
+    Maximum number of bytes held by loaded chunks, including the one being
+    consumed. None disables the limit
+    workers: int
+    Number of background loaders
+    executor: class
+    concurrent.futures executor class, ProcessPoolExecutor requires a
+    picklable load_fn
+    sizeof: callable
+    Returns the number of bytes held by a loaded dataset
+    """
+    def __init__(self, chunks, load_fn, depth=2, memory_budget=None, workers=1, executor=ThreadPoolExecutor,
+                 sizeof=dataset_nbytes):
+
+        assert depth >= 1, 'Prefetch depth must be at least 1'
+
+        self.chunks = chunks
+        self.load_fn = load_fn
+        self.depth = depth
+        self.memory_budget = memory_budget
+        self.workers = workers
+        self.executor = executor
+        self.sizeof = sizeof
+
+        self.waits = []
+        self.start_time = None
+        self.end_time = None
+        self.chunk_nbytes = 0
+        self.current_nbytes = 0
+
+    def buffered_nbytes(self, pending):
+        nbytes = self.current_nbytes
+        for future in pending:
+            if future.done() and future.exception() is None:
+                nbytes += self.sizeof(future.result())
+            else:
+                nbytes += self.chunk_nbytes
+        return nbytes
+
+    def fill(self, executor, chunks, pending):
+        while len(pending) < self.depth:
+            if pending and self.memory_budget is not None and \
+                    self.buffered_nbytes(pending) + self.chunk_nbytes > self.memory_budget:
+                return
+
+            try:
+                indices, norm_params = next(chunks)
+            except StopIteration:
+                return
+
+            pending.append(executor.submit(self.load_fn, indices, norm_params))
+
+    def __iter__(self):
+        self.waits = []
+        self.current_nbytes = 0
+        self.start_time, self.end_time = time.perf_counter(), None
+        chunks = iter(self.chunks)
+        pending = deque()
+
+        with self.executor(max_workers=self.workers) as executor:
+            try:
+                self.fill(executor, chunks, pending)
+
+                while pending:
+                    wait_start = time.perf_counter()
+                    dataset = pending.popleft().result()
+                    self.waits.append(time.perf_counter() - wait_start)
+
+                    self.current_nbytes = self.chunk_nbytes = self.sizeof(dataset)
+                    self.fill(executor, chunks, pending)
+
+                    yield dataset
+
+                    self.current_nbytes = 0
+                    self.fill(executor, chunks, pending)
+            finally:
+                for future in pending:
+                    future.cancel()
+                self.end_time = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    @property
+    def wait_time(self):
+        return sum(self.waits)
+
+    def stats(self):
+        """Wait-time metrics of the last iteration. A wait_ratio close to 1
+        means training is I/O-bound, close to 0 means it is compute-bound."""
+        return {'chunks': len(self.waits),
+                'wait_time': self.wait_time,
+                'max_wait': max(self.waits, default=0.0),
+                'elapsed': self.elapsed,
+                'wait_ratio': self.wait_time / self.elapsed if self.elapsed else 0.0}
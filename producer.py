@@ -1,17 +1,20 @@
 import datetime 
-import time 
+import inspect 
 import pytz 
 import logging 
-import json 
-import pickle 
-from kafka import KafkaProducer
-from collections import defaultdict 
+from publisher import get_sink
 from config import tokens, time_zone, kafka_config, event_list 
-from config import get_cot, get_vix, get_stock_volume
-from getMarketData import GetData, get_market_calendar
+from config import get_cot, get_vix, get_stock_volume, user_agent
+from getmarketdata import GetData, get_market_calendar, get_session, set_default_session
+from record_replay import market_data_session, set_spider_mode, spider_settings
+from av_scheduler import get_scheduler
 from economic_indicators_spider import run_indicator_spider 
 from cot_reports_spider import run_cot_spider 
 from vix_spider import run_vix_spider
+from tick_scheduler import TickScheduler
+from spider_service import SpiderService
+from latency import default_recorder, MetricsServer
+from checkpoint import get_checkpoint, checkpointed, resume_offset, checkpoint_scope, default_checkpoint_path
 
 def get_data_point(source, tokens, timestamp, request=None, function=None, symbol=None, interval=None, \
                    output_format='json'):
@@ -20,7 +23,9 @@ def get_data_point(source, tokens, timestamp, request=None, function=None, symbo
     if source == 'IEX':
         raw_data = get.get_iex_data(request, timestamp)
     elif source == 'AV':
-        raw_data = get.get_av_data(timestamp, function, symbol, interval, request)
+        raw_data = get_scheduler(tokens, output_format).get_av_data(timestamp, function, symbol, interval, request)
+    elif source == 'IEX_BATCH':
+        raw_data = get.get_iex_batch(symbol, timestamp, types=request or 'quote')
     else:
         logging.warning('Source isnt recognised')
     return raw_data 
@@ -37,72 +42,134 @@ def market_hour_to_dt(current_datetime, hour_str):
     dt = current_datetime.replace(hour=mh, minute=mm, second=0, microsecond=0)
     return dt 
 
-def intraday_data(freq, market_hours, current_datetime, source, tokens, economic_data, cot=False, vix=False, request=None, \
-                  function=None, symbol=None, interval=None, output_format='json', get_stock_volume=None):
-    
-    producer = KafkaProducer(bootstrap_servers=kafka_config['servers'],
-        value_serializer=lambda x:
-        json.dumps(x).encode('utf-8'))
-    
-    with open(r"items.pickle", "wb") as output_file:
-        pickle.dump(defaultdict(), output_file)
+def tick_datetime(timestamp):
+    return pytz.utc.localize(datetime.datetime.utcfromtimestamp(timestamp)).astimezone(time_zone['EST'])
+
+def market_is_open(market_hours):
+    now = pytz.utc.localize(datetime.datetime.utcnow()).astimezone(time_zone['EST'])
+    return (now >= market_hours['market_start']) and (now <= market_hours['market_end'])
+
+def add_source(scheduler, name, fn, cadence, missed_tick_policy='skip', checkpoint=None, scope=None):
+    """Schedules a source, resuming after the last tick it finished under
+    `scope` when a checkpoint is given."""
+    offset = 0.0
+    if checkpoint is not None:
+        offset = resume_offset(checkpoint, name, cadence, scope=scope)
+        fn = checkpointed(checkpoint, name, fn, scope)
+    scheduler.add(name, fn, cadence, missed_tick_policy, offset=offset)
+
+def spider_kwargs(runner, spider_service):
+    """Passes the SpiderService only to the spider runners that take one,
+    the others keeping their process per crawl."""
+    if spider_service is None:
+        return {}
+    if 'service' not in inspect.signature(runner).parameters:
+        logging.warning('{} does not support a persistent spider service'.format(runner.__name__))
+        return {}
+    return {'service': spider_service}
+
+def add_spider_sources(scheduler, freq, economic_data, cot=False, vix=False, cadences=None, missed_tick_policy='skip', \
+                       spider_service=None, checkpoint=None, scope=None):
+    """Schedules the economic indicator, COT and VIX spiders on a TickScheduler."""
+    cadences = dict({'economic': freq, 'cot': 7 * 24 * 60 * 60, 'vix': freq}, **(cadences or {}))
+    indicator_kwargs = spider_kwargs(run_indicator_spider, spider_service)
+    cot_kwargs = spider_kwargs(run_cot_spider, spider_service)
+    vix_kwargs = spider_kwargs(run_vix_spider, spider_service)
+
+    def send_economic_data(timestamp):
+        with default_recorder.span('spider.economic'):
+            run_indicator_spider(economic_data['countries'], economic_data['importance'], economic_data['event_list'], \
+                                tick_datetime(timestamp), kafka_config['servers'], kafka_config['topics'][3], **indicator_kwargs)
 
-    while (current_datetime >= market_hours['market_start']) and (current_datetime <= market_hours['market_end']):
+    def send_cot_data(timestamp):
+        with default_recorder.span('spider.cot'):
+            run_cot_spider(economic_data['cot'], tick_datetime(timestamp), kafka_config['servers'], kafka_config['topics'][2], \
+                           **cot_kwargs)
 
-        try:
+    def send_vix_data(timestamp):
+        with default_recorder.span('spider.vix'):
+            run_vix_spider(tick_datetime(timestamp), kafka_config['servers'], kafka_config['topics'][0], **vix_kwargs)
 
-            process_start_time = time.time()
+    add_source(scheduler, 'economic', send_economic_data, cadences['economic'], missed_tick_policy, checkpoint, scope)
 
-            market_data = get_data_point(source, tokens, current_datetime, request=request, function=function, symbol=symbol, \
-                                        interval=interval, output_format=output_format)
-            
-            if get_stock_volume and (source != 'AV' and function != 'TIME_SERIES_INTRADAY'):
-                interval = freq // 60
-                interval = '{:d}min'.format(interval)
+    if cot:
+        add_source(scheduler, 'cot', send_cot_data, cadences['cot'], missed_tick_policy, checkpoint, scope)
 
-                if interval in ['1min', '5min', '15min', '30min', '60min']:
-                    volume = get_data_point('AV', tokens, current_datetime, function='TIME_SERIES_INTRADAY',
-                        symbol=get_stock_volume, interval=interval, output_format=output_format)
-                    
-                    producer.send(topic=kafka_config['topics'][1], value=volume)
+    if vix:
+        add_source(scheduler, 'vix', send_vix_data, cadences['vix'], missed_tick_policy, checkpoint, scope)
 
-                else:
-                    logging.warning('"{}" interval is not supported'.format(interval))
+def intraday_data(freq, market_hours, current_datetime, source, tokens, economic_data, cot=False, vix=False, request=None, \
+                  function=None, symbol=None, interval=None, output_format='json', get_stock_volume=None, \
+                  cadences=None, missed_tick_policy='skip', spider_service=None, stats_every=None, metrics_port=None, \
+                  checkpoint_path=None):
+    
+    producer = get_sink(kafka_config)
+    
+    scope = checkpoint_scope(source, symbol, function, interval, request)
+    checkpoint = get_checkpoint(checkpoint_path or default_checkpoint_path(scope))
+
+    cadences = dict({'market_data': freq, 'volume': freq}, **(cadences or {}))
 
+    def send_market_data(timestamp):
+        with default_recorder.span('tick.market_data'):
+            market_data = get_data_point(source, tokens, tick_datetime(timestamp), request=request, function=function, \
+                                         symbol=symbol, interval=interval, output_format=output_format)
+            if market_data is None:
+                raise RuntimeError('No market data at this tick')
             producer.send(topic=kafka_config['topics'][4], value=market_data)
 
-            run_indicator_spider(economic_data['countries'], economic_data['importance'], economic_data['event_list'], \
-                                current_datetime, kafka_config['servers'], kafka_config['topics'][3])
-            
-            if cot:
-                run_cot_spider(economic_data['cot'], current_datetime, kafka_config['servers'], kafka_config['topics'][2])
+    def send_volume(timestamp):
+        with default_recorder.span('tick.volume'):
+            volume = get_data_point('AV', tokens, tick_datetime(timestamp), function='TIME_SERIES_INTRADAY',
+                symbol=get_stock_volume, interval=volume_interval, output_format=output_format)
+            if volume is None:
+                raise RuntimeError('No volume data at this tick')
+            producer.send(topic=kafka_config['topics'][1], value=volume)
 
-            if vix:
-                run_vix_spider(current_datetime, kafka_config['servers'], kafka_config['topics'][0])
+    scheduler = TickScheduler()
+    add_source(scheduler, 'market_data', send_market_data, cadences['market_data'], missed_tick_policy, checkpoint, scope)
 
-            process_end_time = time.time()
-            process_time = process_end_time - process_start_time
+    if get_stock_volume and (source != 'AV' and function != 'TIME_SERIES_INTRADAY'):
+        volume_interval = '{:d}min'.format(freq // 60)
 
-            time.sleep(freq - process_time)
+        if volume_interval in ['1min', '5min', '15min', '30min', '60min']:
+            add_source(scheduler, 'volume', send_volume, cadences['volume'], missed_tick_policy, checkpoint, scope)
+        else:
+            logging.warning('"{}" interval is not supported'.format(volume_interval))
 
-            current_datetime = pytz.utc.localize(datetime.datetime.utcnow()).astimezone(time_zone['EST'])
+    add_spider_sources(scheduler, freq, economic_data, cot=cot, vix=vix, cadences=cadences, \
+                       missed_tick_policy=missed_tick_policy, spider_service=spider_service, checkpoint=checkpoint,
+                       scope=scope)
 
-        except KeyboardInterrupt:
-            logging.warning('Action suddenly stopped by the user')
-            break 
+    if stats_every:
+        scheduler.add('stats', default_recorder.log_stats, stats_every, offset=stats_every)
 
-        else:
-            logging.warning('Market is closed')
-            logging.warning('Current time: {} {}'.format(datetime.datetime.strftime(current_datetime, "%Y-%m-%d %I:%M %p"), \
-                current_datetime.tzname()))
-            logging.warning('Market trade hours: from {} to {} {}'.format(datetime.datetime.strftime(market_hours['market_start'], \
-                "%Y-%m-%d %I:%M %p"), datetime.datetime.strftime(market_hours['market_end'], "%Y-%m-%d %I:%M %p"), \
-                market_hours['market_end'].tzname()))
+    metrics_server = MetricsServer(default_recorder, metrics_port).start() if metrics_port else None
+
+    try:
+        scheduler.run(until=lambda: market_is_open(market_hours))
+
+    except KeyboardInterrupt:
+        logging.warning('Action suddenly stopped by the user')
+
+    else:
+        current_datetime = pytz.utc.localize(datetime.datetime.utcnow()).astimezone(time_zone['EST'])
+        logging.warning('Market is closed')
+        logging.warning('Current time: {} {}'.format(datetime.datetime.strftime(current_datetime, "%Y-%m-%d %I:%M %p"), \
+            current_datetime.tzname()))
+        logging.warning('Market trade hours: from {} to {} {}'.format(datetime.datetime.strftime(market_hours['market_start'], \
+            "%Y-%m-%d %I:%M %p"), datetime.datetime.strftime(market_hours['market_end'], "%Y-%m-%d %I:%M %p"), \
+            market_hours['market_end'].tzname()))
+
+    finally:
+        checkpoint.close()
+        if metrics_server is not None:
+            metrics_server.stop()
             
-def start_day_session(freq, source, tokens, economic_data, cot=False, vix=False, request=None, function=None, symbol=None, \
-                    interval=None, output_format='json', get_stock_volume=None):
-    
-    current_datetime = pytz.utc.localize(datetime.datetime.utcnow()).astimezone(time_zone['EST'])
+def get_market_hours(current_datetime, source):
+    """Trading hours of the current day from the market calendar, the pre-
+    and post-market hours being added for IEX, or the bounds of the trading
+    week when the market is closed today."""
     current_date = current_datetime.date()
 
     market_calendar = get_market_calendar()
@@ -112,15 +179,17 @@ def start_day_session(freq, source, tokens, economic_data, cot=False, vix=False,
     is_open = market_day.get('status') == 'open'
 
     if is_open:
+        market_start, market_end = market_day.get('open').values()
+        hours = [('market_start', market_start), ('market_end', market_end)]
 
         if source == 'IEX':
             premarket_start, premarket_end = market_day.get('premarket').values()
-            market_start, market_end = market_day.get('open').values()
             postmarket_start, postmarket_end = market_day.get('postmarket').values()
 
-            hours = [('premarket_start', premarket_start), ('premarket_end', premarket_end), ('market_start', market_start), \
-                     ('market_end', market_end), ('postmarket_start', postmarket_start), ('postmarket_end', postmarket_end)]
-            market_hours = {key: market_hour_to_dt(current_datetime, value) for key, value in hours}
+            hours += [('premarket_start', premarket_start), ('premarket_end', premarket_end), \
+                      ('postmarket_start', postmarket_start), ('postmarket_end', postmarket_end)]
+
+        market_hours = {key: market_hour_to_dt(current_datetime, value) for key, value in hours}
 
     else:
         market_hours = {}
@@ -131,15 +200,35 @@ def start_day_session(freq, source, tokens, economic_data, cot=False, vix=False,
         market_end = current_datetime.replace(hour=16, minute=0, second=0, microsecond=0, tzinfo=time_zone['EST'])
         market_hours['market_end'] = market_end + datetime.timedelta(days=-(current_datetime.weekday() - 4))
 
+    return market_hours
+
+def spider_log(data_log):
+    """Log of the spider responses recorded next to the market data log."""
+    return '{}.spiders'.format(data_log)
+
+def start_day_session(freq, source, tokens, economic_data, cot=False, vix=False, request=None, function=None, symbol=None, \
+                    interval=None, output_format='json', get_stock_volume=None, data_mode=None, data_log=None, \
+                    replay_speed=None, persistent_spiders=False, stats_every=None, metrics_port=None, \
+                    checkpoint_path=None):
     
-    intraday_data(freq, market_hours, current_datetime, source, tokens, economic_data, cot=cot, vix=vix, request=request,
-                  function=function, symbol=symbol, interval=interval, output_format=output_format,
-                  get_stock_volume=get_stock_volume)
+    if data_mode is not None:
+        set_default_session(market_data_session(data_mode, data_log, replay_speed, get_session()))
+        set_spider_mode(data_mode, spider_log(data_log), replay_speed)
+
+    current_datetime = pytz.utc.localize(datetime.datetime.utcnow()).astimezone(time_zone['EST'])
+    market_hours = get_market_hours(current_datetime, source)
     
-else:
-logging.warning('Current time {} {}'.format(datetime.datetime.strftime(current_datetime, "%Y-%m-%d %I:%M %p"), \
-    current_datetime.tzname()))
-logging.warning('Today market is closed')
+    spider_service = SpiderService(dict({'USER_AGENT': user_agent}, **spider_settings())).start() \
+        if persistent_spiders else None
+
+    try:
+        intraday_data(freq, market_hours, current_datetime, source, tokens, economic_data, cot=cot, vix=vix, request=request,
+                      function=function, symbol=symbol, interval=interval, output_format=output_format,
+                      get_stock_volume=get_stock_volume, spider_service=spider_service, stats_every=stats_every,
+                      metrics_port=metrics_port, checkpoint_path=checkpoint_path)
+    finally:
+        if spider_service is not None:
+            spider_service.stop()
 
 freq = 60 * 5
 
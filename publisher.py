@@ -0,0 +1,366 @@
+import os
+import json
+import time
+import struct
+import logging
+import threading
+from collections import deque
+from book_snapshot import OrderBookSnapshot
+from latency import default_recorder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = struct.Struct('<2sBH')
+MAGIC = b'PP'
+RECORD = struct.Struct('<dHHI')
+
+DEFAULT_SETTINGS = {
+    'linger_ms': 20,
+    'batch_size': 256 * 1024,
+    'compression': 'lz4',
+    'serializer': 'json',
+    'schema': 1,
+}
+
+
+def to_plain(value):
+    if isinstance(value, OrderBookSnapshot):
+        return value.to_record()
+    raise TypeError('{} is not serializable'.format(type(value).__name__))
+
+
+class JSONSerializer:
+    """Text JSON readable by the consumers of the original json.dumps
+    serializer, the output using compact separators when orjson is
+    installed. Values orjson cannot encode, e.g. integers beyond 64 bits,
+    fall back to json.dumps."""
+    name = 'json'
+
+    def encode(self, value):
+        if orjson is not None:
+            try:
+                return orjson.dumps(value, default=to_plain,
+                                    option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                pass
+        return json.dumps(value, default=to_plain).encode('utf-8')
+
+    def decode(self, data):
+        return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class BinarySerializer:
+    """Binary encoding prefixed by a schema header (magic, codec and schema
+    version) so consumers can tell the codec and the record layout of each
+    message. Order-book snapshots are written with their own array layout,
+    other values with msgpack or, when it is not installed, orjson.
+
+    Parameters
+    ----------
+    schema: int
+    Version of the record layout written in the header
+    """
+    name = 'binary'
+
+    MSGPACK = 1
+    JSON = 2
+    BOOK = 3
+
+    def __init__(self, schema=1):
+
+        self.schema = schema
+
+    def header(self, codec):
+        return HEADER.pack(MAGIC, codec, self.schema)
+
+    def encode(self, value):
+        if isinstance(value, OrderBookSnapshot):
+            return self.header(self.BOOK) + value.to_bytes()
+        if msgpack is not None:
+            return self.header(self.MSGPACK) + msgpack.packb(value, default=to_plain, use_bin_type=True)
+        return self.header(self.JSON) + JSONSerializer().encode(value)
+
+    @staticmethod
+    def decode(data):
+        """Returns the (schema, value) of a message written by encode."""
+        magic, codec, schema = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('Message has no schema header')
+
+        body = memoryview(data)[HEADER.size:]
+        if codec == BinarySerializer.BOOK:
+            return schema, OrderBookSnapshot.from_bytes(body)
+        if codec == BinarySerializer.MSGPACK:
+            return schema, msgpack.unpackb(body, raw=False)
+        if codec == BinarySerializer.JSON:
+            return schema, JSONSerializer().decode(bytes(body))
+        raise ValueError('{} codec is not supported'.format(codec))
+
+
+SERIALIZERS = {'json': JSONSerializer, 'binary': BinarySerializer}
+
+
+def get_serializer(serializer, schema=1):
+    """Returns a serializer from its name, or `serializer` itself when it is
+    already an object with an encode method."""
+    if not isinstance(serializer, str):
+        return serializer
+    assert serializer in SERIALIZERS, '{} serializer is not supported'.format(serializer)
+    return SERIALIZERS[serializer](schema) if serializer == 'binary' else SERIALIZERS[serializer]()
+
+
+def available_compression(compression):
+    """Returns `compression`, or None with a warning when its codec library
+    is not installed."""
+    if compression is None:
+        return None
+
+    from kafka import codec
+    available = {'gzip': codec.has_gzip, 'snappy': codec.has_snappy, 'lz4': codec.has_lz4,
+                 'zstd': getattr(codec, 'has_zstd', lambda: False)}
+    assert compression in available, '{} compression is not supported'.format(compression)
+
+    if not available[compression]():
+        logging.warning('{} codec is not installed, sending uncompressed messages'.format(compression))
+        return None
+    return compression
+
+
+class KafkaPublisher:
+    """KafkaProducer tuned for throughput: messages are serialized by a
+    pluggable serializer, compressed in batches and held up to linger_ms so
+    batches fill up.
+
+    Handing a record to the producer buffer is timed as the 'enqueue' stage,
+    and the time from then until the broker acknowledges it as the
+    'delivery' stage, or 'delivery_error' when it fails.
+
+    Parameters
+    ----------
+    servers: list
+    List of brokers
+    linger_ms: int
+    Time a message may wait for its batch to fill
+    batch_size: int
+    Maximum size in bytes of a batch per partition
+    compression: str
+    'lz4', 'zstd', 'gzip', 'snappy' or None
+    serializer: str or object
+    'json', 'binary' or an object with an encode(value) method
+    schema: int
+    Schema version written by the binary serializer
+    """
+    def __init__(self, servers, linger_ms=20, batch_size=256 * 1024, compression='lz4', serializer='json',
+                 schema=1, **producer_kwargs):
+
+        from kafka import KafkaProducer
+
+        self.serializer = get_serializer(serializer, schema)
+        self.producer = KafkaProducer(bootstrap_servers=servers, linger_ms=linger_ms, batch_size=batch_size,
+                                      compression_type=available_compression(compression), **producer_kwargs)
+
+    @staticmethod
+    def delivered(started, metadata):
+        default_recorder.record('delivery', time.perf_counter() - started)
+
+    @staticmethod
+    def failed(started, exception):
+        default_recorder.record('delivery_error', time.perf_counter() - started)
+
+    def track(self, future, started):
+        """Records the delivery latency of a record once its future resolves."""
+        future.add_callback(self.delivered, started)
+        future.add_errback(self.failed, started)
+        return future
+
+    def send(self, topic, value, key=None):
+        with default_recorder.span('serialize'):
+            data = self.serializer.encode(value)
+        started = time.perf_counter()
+        with default_recorder.span('enqueue'):
+            future = self.producer.send(topic, value=data, key=key)
+        return self.track(future, started)
+
+    def send_many(self, topic, values, key=None):
+        """Serializes and queues every value, the producer sending them in as
+        few batches as linger_ms and batch_size allow. Returns the futures of
+        the records."""
+        encode = self.serializer.encode
+        send = self.producer.send
+        with default_recorder.span('serialize'):
+            data = [encode(value) for value in values]
+        futures = []
+        with default_recorder.span('enqueue'):
+            for value in data:
+                started = time.perf_counter()
+                futures.append(self.track(send(topic, value=value, key=key), started))
+        return futures
+
+    def flush(self, timeout=None):
+        self.producer.flush(timeout)
+
+    def close(self, timeout=None):
+        self.producer.close(timeout)
+
+
+class FileLogSink:
+    """Append-only local log standing in for Kafka. Each record holds its
+    timestamp, topic, key and serialized value, and is written with a single
+    append so several processes can share the log.
+
+    Parameters
+    ----------
+    path: str
+    Log file, appended to
+    serializer: str or object
+    'json', 'binary' or an object with an encode(value) method
+    schema: int
+    Schema version written by the binary serializer
+    fsync: bool
+    Whether flush also syncs the log to disk
+    """
+    def __init__(self, path, serializer='json', schema=1, fsync=False):
+
+        self.path = path
+        self.serializer = get_serializer(serializer, schema)
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    @staticmethod
+    def record(topic, value, key=None):
+        topic = topic.encode('utf-8')
+        key = key or b''
+        return RECORD.pack(time.time(), len(topic), len(key), len(value)) + topic + key + value
+
+    def send(self, topic, value, key=None):
+        with default_recorder.span('serialize'):
+            data = self.record(topic, self.serializer.encode(value), key)
+        with default_recorder.span('send'), self.lock:
+            os.write(self.fd, data)
+
+    def send_many(self, topic, values, key=None):
+        encode = self.serializer.encode
+        with default_recorder.span('serialize'):
+            data = b''.join(self.record(topic, encode(value), key) for value in values)
+        with default_recorder.span('send'), self.lock:
+            os.write(self.fd, data)
+
+    def flush(self, timeout=None):
+        if self.fsync:
+            os.fsync(self.fd)
+
+    def close(self, timeout=None):
+        with self.lock:
+            os.close(self.fd)
+
+
+def read_sink_log(path, topic=None):
+    """Yields the (timestamp, topic, key, value) records of a FileLogSink log,
+    the values being the serialized bytes. Only the records of `topic` are
+    returned when it is given."""
+    with open(path, 'rb') as file:
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, topic_len, key_len, value_len = RECORD.unpack(header)
+            record_topic = file.read(topic_len).decode('utf-8')
+            key = file.read(key_len) or None
+            value = file.read(value_len)
+            if len(value) < value_len:
+                return
+            if topic is None or topic == record_topic:
+                yield timestamp, record_topic, key, value
+
+
+class RingBufferSink:
+    """In-memory sink keeping the last `capacity` serialized records, to run
+    and profile the producer without a broker. Records only reach the buffer
+    of the process that sent them.
+
+    Parameters
+    ----------
+    capacity: int
+    Number of records kept
+    serializer: str or object
+    'json', 'binary' or an object with an encode(value) method
+    schema: int
+    Schema version written by the binary serializer
+    """
+    def __init__(self, capacity=100000, serializer='json', schema=1):
+
+        self.serializer = get_serializer(serializer, schema)
+        self.buffer = deque(maxlen=capacity)
+        self.sent = 0
+
+    def send(self, topic, value, key=None):
+        with default_recorder.span('serialize'):
+            data = self.serializer.encode(value)
+        self.buffer.append((time.time(), topic, key, data))
+        self.sent += 1
+
+    def send_many(self, topic, values, key=None):
+        encode = self.serializer.encode
+        now = time.time()
+        with default_recorder.span('serialize'):
+            data = [encode(value) for value in values]
+        self.buffer.extend((now, topic, key, value) for value in data)
+        self.sent += len(data)
+
+    def records(self, topic=None):
+        """Returns the (timestamp, topic, key, value) records in the buffer."""
+        return [record for record in list(self.buffer) if topic is None or record[1] == topic]
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
+
+
+SINKS = {'kafka': KafkaPublisher, 'file': FileLogSink, 'memory': RingBufferSink}
+
+SINK_SETTINGS = {
+    'kafka': DEFAULT_SETTINGS,
+    'file': {'path': 'sink.log', 'serializer': 'json', 'schema': 1, 'fsync': False},
+    'memory': {'capacity': 100000, 'serializer': 'json', 'schema': 1},
+}
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+def settings_key(value):
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, (str, int, float, type(None))):
+        return value
+    return id(value)
+
+def get_sink(config):
+    """Returns the sink of this process for a kafka_config dict, kept open
+    across ticks and crawls. config['sink'] selects 'kafka' (the default,
+    using 'servers' plus optional linger_ms, batch_size, compression,
+    serializer and schema), 'file' (path, serializer, schema, fsync) or
+    'memory' (capacity, serializer, schema)."""
+    sink = config.get('sink', 'kafka')
+    assert sink in SINKS, '{} sink is not supported'.format(sink)
+
+    settings = {name: config.get(name, default) for name, default in SINK_SETTINGS[sink].items()}
+    if sink == 'kafka':
+        settings['servers'] = config['servers']
+
+    key = (sink, tuple((name, settings_key(value)) for name, value in sorted(settings.items())))
+
+    with _sinks_lock:
+        if key not in _sinks:
+            _sinks[key] = SINKS[sink](**settings)
+        return _sinks[key]
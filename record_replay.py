@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import struct
+import threading
+from collections import defaultdict, deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+RECORD = struct.Struct('<dHII')
+SECRET_PARAMS = ('token', 'apikey')
+
+
+def url_key(url):
+    """URL without its token/apikey parameters, used to match recorded
+    responses and to keep secrets out of the log."""
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in SECRET_PARAMS]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+
+def read_log(path):
+    """Yields the (timestamp, url, status, body) records of a response log."""
+    with open(path, 'rb') as file:
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, status, url_len, body_len = RECORD.unpack(header)
+            url = file.read(url_len).decode('utf-8')
+            body = file.read(body_len)
+            if len(body) < body_len:
+                return
+            yield timestamp, url, status, body
+
+
+class ReplayResponse:
+    """Minimal requests.Response stand-in served by ReplaySession."""
+    def __init__(self, url, status_code, content):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.exceptions.HTTPError('{} replayed for {}'.format(self.status_code, self.url))
+
+
+class RecordingSession:
+    """Wraps a requests session and appends every response body with its
+    timestamp to an append-only log.
+
+    Parameters
+    ----------
+    path: str
+    Log file, appended to
+    session: requests.Session
+    Session performing the live requests
+    """
+    def __init__(self, path, session):
+
+        self.path = path
+        self.session = session
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+
+    def append(self, url, status, body):
+        url = url_key(url).encode('utf-8')
+        with self.lock:
+            self.file.write(RECORD.pack(time.time(), status, len(url), len(body)) + url + body)
+            self.file.flush()
+
+    def get(self, url, **kwargs):
+        response = self.session.get(url, **kwargs)
+        self.append(url, response.status_code, response.content)
+        return response
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class ReplaySession:
+    """Serves the responses of a log written by RecordingSession in place of
+    a requests session. Responses to the same URL are replayed in recording
+    order, the last one being repeated once they run out.
+
+    Parameters
+    ----------
+    path: str
+    Log file
+    speed: float
+    1.0 replays at the original pace, 2.0 twice as fast, None as fast as
+    possible
+    """
+    def __init__(self, path, speed=None):
+
+        self.speed = speed
+        self.responses = defaultdict(deque)
+        self.lock = threading.Lock()
+        self.first_timestamp = None
+        self.start_time = None
+
+        for timestamp, url, status, body in read_log(path):
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+            self.responses[url].append((timestamp, status, body))
+
+    def wait(self, timestamp):
+        if not self.speed:
+            return
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.monotonic()
+        delay = self.start_time + (timestamp - self.first_timestamp) / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        key = url_key(url)
+        with self.lock:
+            queue = self.responses.get(key)
+            if not queue:
+                return ReplayResponse(url, 404, b'')
+            timestamp, status, body = queue.popleft() if len(queue) > 1 else queue[0]
+
+        self.wait(timestamp)
+        return ReplayResponse(url, status, body)
+
+    def close(self):
+        pass
+
+
+class RecordReplayMiddleware:
+    """Scrapy downloader middleware recording or replaying spider responses
+    with the same log format. Enabled through the RECORD_REPLAY_MODE
+    ('record' or 'replay') and RECORD_REPLAY_PATH settings, see
+    spider_settings."""
+    def __init__(self, mode, path, speed=None):
+
+        self.mode = mode
+        if mode == 'record':
+            self.log = RecordingSession(path, session=None)
+        elif mode == 'replay':
+            self.log = ReplaySession(path, speed)
+        else:
+            self.log = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from scrapy.exceptions import NotConfigured
+
+        settings = crawler.settings
+        if not settings.get('RECORD_REPLAY_MODE'):
+            raise NotConfigured
+        return cls(settings.get('RECORD_REPLAY_MODE'), settings.get('RECORD_REPLAY_PATH'),
+                   settings.getfloat('RECORD_REPLAY_SPEED') or None)
+
+    def process_request(self, request, spider=None):
+        if self.mode != 'replay':
+            return None
+
+        from scrapy.http import HtmlResponse
+        response = self.log.get(request.url)
+        return HtmlResponse(url=request.url, status=response.status_code, body=response.content, request=request)
+
+    def process_response(self, request, response, spider=None):
+        if self.mode == 'record':
+            self.log.append(request.url, response.status, response.body)
+        return response
+
+
+MIDDLEWARE = {'record_replay.RecordReplayMiddleware': 950}
+
+_spider_settings = {}
+
+def set_spider_mode(mode=None, path=None, speed=None):
+    """Makes the spiders started from now on in this process (and the
+    processes it forks) record their responses to, or replay them from,
+    `path`. None restores live crawling."""
+    global _spider_settings
+    if mode is None:
+        _spider_settings = {}
+        return
+    if mode not in ('record', 'replay'):
+        raise ValueError('{} mode is not supported'.format(mode))
+    if mode == 'replay' and not os.path.exists(path):
+        raise FileNotFoundError('No recorded spider responses at {}'.format(path))
+
+    _spider_settings = {'RECORD_REPLAY_MODE': mode, 'RECORD_REPLAY_PATH': path, 'RECORD_REPLAY_SPEED': speed or 0,
+                        'DOWNLOADER_MIDDLEWARES': MIDDLEWARE}
+
+def spider_settings():
+    """Scrapy settings enabling RecordReplayMiddleware in the mode set by
+    set_spider_mode, empty when the spiders crawl live."""
+    return dict(_spider_settings)
+
+
+def market_data_session(mode=None, path=None, speed=None, session=None):
+    """Returns the session GetData should use: `session` itself when `mode`
+    is None, or a recording or replaying wrapper writing/reading `path`."""
+    if mode is None:
+        return session
+    if mode == 'record':
+        return RecordingSession(path, session)
+    if mode == 'replay':
+        if not os.path.exists(path):
+            raise FileNotFoundError('No recorded responses at {}'.format(path))
+        return ReplaySession(path, speed)
+    raise ValueError('{} mode is not supported'.format(mode))
@@ -1,14 +1,20 @@
-from biliard import Process 
+from billiard import Process 
 from scrapy import Spider, Request 
+from scrapy.crawler import Crawler
 from scrapy import signals as scrapy_signals 
-from kafka import KafkaProducer 
+from publisher import get_sink
 from twisted.internet import reactor 
-from config import user_agent 
+from config import user_agent, kafka_config
+from record_replay import MIDDLEWARE, spider_settings
 from datetime import datetime 
 import logging 
-import json 
 
-logging.basisConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.DEBUG)
+
+def get_producer(server):
+    """Returns the publisher of this process for the given brokers, kept open
+    across crawls when the spiders run in a persistent SpiderService."""
+    return get_sink(dict(kafka_config, servers=server))
 
 class COTCollectorPipeline:
     """Implementation of the Scrapy Pipeline that sends scraped COT data
@@ -25,9 +31,7 @@ class COTCollectorPipeline:
         self.servver = server 
         self.topic = topic 
         self.items = {}
-        self.producer = KafkaProducer(boostrap_servers=server,
-            value_serializer=lambda x:
-            json.dumps(x).encode('utf-8'))
+        self.producer = get_producer(server)
         
     def process_item(self, item, spider):
         self.items.update(item)
@@ -40,7 +44,6 @@ class COTCollectorPipeline:
     def close_spider(self, spider):
         self.producer.send(topic=self.topic, value=self.items)
         self.producer.flush()
-        self.producer.close()
 
 def to_number(v):
     try:
@@ -72,7 +75,8 @@ class COIreportsSpiderSpider(Spider):
     custom_settings = {
         'ITEM_PIPELINES': {
             'cot_reports_spider.COICollectorPipeline': 100
-        }
+        },
+        'DOWNLOADER_MIDDLEWARES': MIDDLEWARE
     }
 
     def __init__(self, report_subject, current_dt, server, topic):
@@ -146,10 +150,12 @@ class CrawlerScript(Process):
         self.topic = topic 
 
         self.crawler = Crawler(
-            COTreportsSpiderSpider,
-            settings={
-                'USER_AGENT': user_agnet
-            }
+            COIreportsSpiderSpider,
+            settings=dict({
+                'USER_AGENT': user_agent,
+                # runs on the default reactor imported above
+                'TWISTED_REACTOR': None
+            }, **spider_settings())
         )
 
         self.crawler.signals.connect(reactor.stop, signal=scrapy_signals.spider_closed)
@@ -158,7 +164,11 @@ class CrawlerScript(Process):
         self.crawler.crawl(self.report_subject, self.current_dt, self.server, self.topic)
         reactor.run()
 
-def run_cot_spider(report_subject, current_dt, server, topic):
+def run_cot_spider(report_subject, current_dt, server, topic, service=None, timeout=15 * 60):
+
+    if service is not None:
+        service.crawl('reports:COIreportsSpiderSpider', report_subject, current_dt, server, topic).result(timeout)
+        return
 
     crawler = CrawlerScript(report_subject, current_dt, server, topic)
 
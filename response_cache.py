@@ -0,0 +1,69 @@
+import threading
+from Config import PeriodicCache
+from record_replay import url_key
+
+INTERVAL_SECONDS = {'1min': 60, '5min': 5 * 60, '15min': 15 * 60, '30min': 30 * 60, '60min': 60 * 60}
+
+DEFAULT_TTLS = {
+    'calendar': 24 * 60 * 60,
+    'av': 60,
+    'iex': 0,
+}
+
+
+class ResponseCache:
+    """In-memory cache of raw response bodies keyed by URL without its
+    token, with one PeriodicCache per TTL so entries expire on wall-clock
+    boundaries (a 5min intraday response expires when the next bar is due).
+
+    Parameters
+    ----------
+    ttls: dict
+    Seconds to keep the responses of each endpoint ('calendar', 'av', 'iex'),
+    0 disables caching for that endpoint. Alpha Vantage intraday requests use
+    their bar interval instead
+    maxsize: int
+    Maximum number of responses kept per TTL
+    """
+    def __init__(self, ttls=None, maxsize=1024):
+
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.maxsize = maxsize
+        self.caches = {}
+        self.lock = threading.Lock()
+
+    def ttl(self, endpoint, interval=None):
+        if endpoint == 'av' and interval in INTERVAL_SECONDS:
+            return INTERVAL_SECONDS[interval]
+        return self.ttls.get(endpoint, 0)
+
+    def get(self, endpoint, url, fetch, interval=None):
+        """Returns the cached body of `url`, or calls `fetch` which returns
+        (body, cacheable) and stores the body when it is cacheable."""
+        ttl = self.ttl(endpoint, interval)
+        if not ttl:
+            return fetch()[0]
+
+        key = url_key(url)
+        with self.lock:
+            cache = self.caches.get(ttl)
+            if cache is None:
+                cache = self.caches[ttl] = PeriodicCache(self.maxsize, ttl)
+            try:
+                return cache[key]
+            except KeyError:
+                pass
+
+        body, cacheable = fetch()
+        if cacheable:
+            with self.lock:
+                cache[key] = body
+        return body
+
+    def clear(self):
+        with self.lock:
+            for cache in self.caches.values():
+                cache.clear()
+
+
+default_response_cache = ResponseCache()
@@ -0,0 +1,153 @@
+import queue
+import logging
+import importlib
+import threading
+import itertools
+from concurrent.futures import Future
+from billiard import Process, Queue
+
+
+def load_spider(spider_path):
+    module, name = spider_path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def serve(requests, results, settings):
+    """Body of the spider worker: one Twisted reactor that keeps running and
+    starts a crawl for every request taken from the queue."""
+    from scrapy.settings import Settings
+    from scrapy.utils.reactor import install_reactor
+
+    settings = Settings(settings)
+    if settings.get('TWISTED_REACTOR'):
+        install_reactor(settings.get('TWISTED_REACTOR'))
+
+    from twisted.internet import reactor
+    from scrapy.crawler import CrawlerRunner
+
+    runner = CrawlerRunner(settings)
+
+    def start_crawl(request_id, spider_path, args, kwargs):
+        try:
+            deferred = runner.crawl(load_spider(spider_path), *args, **kwargs)
+        except Exception as msg:
+            results.put((request_id, str(msg)))
+            return
+
+        deferred.addCallbacks(lambda _: results.put((request_id, None)),
+                              lambda failure: results.put((request_id, failure.getErrorMessage())))
+
+    def poll():
+        while True:
+            request = requests.get()
+            if request is None:
+                reactor.callFromThread(reactor.stop)
+                return
+            reactor.callFromThread(start_crawl, *request)
+
+    threading.Thread(target=poll, daemon=True).start()
+    reactor.run(installSignalHandlers=False)
+
+
+class SpiderService:
+    """Long-lived spider worker process keeping one Twisted reactor and one
+    Scrapy CrawlerRunner alive, so a crawl only costs its network time instead
+    of a process, a reactor and a crawler start-up per tick. Scraped items
+    still flow to Kafka through the spiders' pipelines.
+
+    When the worker dies, the crawls it was running fail instead of waiting
+    forever, and the next crawl starts a new worker.
+
+    Parameters
+    ----------
+    settings: dict
+    Scrapy settings shared by every crawl
+    poll_interval: float
+    Seconds between two checks that the worker is still alive
+    """
+    def __init__(self, settings=None, poll_interval=1.0):
+
+        self.settings = settings or {}
+        self.poll_interval = poll_interval
+        self.requests = None
+        self.results = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.process = None
+        self.listener = None
+
+    def start(self):
+        if self.listener is not None and self.listener.is_alive():
+            self.results.put(None)
+        self.fail_pending('Spider worker was restarted')
+
+        self.requests = Queue()
+        self.results = Queue()
+        self.process = Process(target=serve, args=(self.requests, self.results, self.settings), daemon=True)
+        self.process.start()
+
+        self.listener = threading.Thread(target=self.listen, args=(self.process, self.results), daemon=True)
+        self.listener.start()
+        return self
+
+    def fail_pending(self, message):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError(message))
+
+    def listen(self, process, results):
+        while True:
+            try:
+                result = results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if not process.is_alive():
+                    logging.warning('Spider worker stopped with exit code {}'.format(process.exitcode))
+                    self.fail_pending('Spider worker stopped')
+                    return
+                continue
+
+            if result is None:
+                return
+
+            request_id, error = result
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            if future is None:
+                continue
+
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(RuntimeError(error))
+
+    def crawl(self, spider_path, *args, **kwargs):
+        """Queues a crawl of the spider at 'module:Class' with the given
+        arguments and returns a Future resolved when the spider closes."""
+        if self.process is None or not self.process.is_alive():
+            logging.warning('Spider worker is not running, starting it')
+            self.start()
+
+        future = Future()
+        request_id = next(self.ids)
+        with self.lock:
+            self.pending[request_id] = future
+
+        self.requests.put((request_id, spider_path, args, kwargs))
+        return future
+
+    def stop(self, timeout=None):
+        if self.process is not None:
+            self.requests.put(None)
+            self.process.join(timeout)
+            self.process = None
+        if self.listener is not None and self.listener.is_alive():
+            self.results.put(None)
+        self.fail_pending('Spider worker was stopped')
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
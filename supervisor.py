@@ -0,0 +1,238 @@
+import time
+import queue
+import logging
+import datetime
+import pytz
+from billiard import Process, Queue
+from config import time_zone, kafka_config, user_agent
+from getmarketdata import GetData
+from publisher import get_sink
+from producer import get_data_point, get_market_hours, market_is_open, add_spider_sources, tick_datetime
+from spider_service import SpiderService
+from record_replay import spider_settings
+from tick_scheduler import TickScheduler
+from av_scheduler import get_scheduler
+
+
+def shard_symbols(symbols, shards):
+    """Splits a symbol universe into `shards` lists of nearly equal size,
+    keeping the order of the symbols."""
+    symbols = list(symbols)
+    assert shards > 0, 'Number of shards must be positive'
+    return [symbols[i::shards] for i in range(shards)]
+
+
+def shard_tokens(tokens, shards, per_minute=5, per_day=500):
+    """Splits the Alpha Vantage tokens across `shards` so the shards never
+    exceed their limits together. With at least as many tokens as shards each
+    shard gets its own tokens, otherwise the shards sharing a token split its
+    per-minute and per-day limits. Returns the (tokens, per_minute, per_day)
+    of every shard."""
+    av_tokens = tokens['av_token']
+    if isinstance(av_tokens, str):
+        av_tokens = [av_tokens]
+
+    if len(av_tokens) >= shards:
+        return [(dict(tokens, av_token=av_tokens[i::shards]), per_minute, per_day) for i in range(shards)]
+
+    split = []
+    for shard in range(shards):
+        token = shard % len(av_tokens)
+        sharing = len(range(token, shards, len(av_tokens)))
+        assert per_minute // sharing > 0, 'Not enough Alpha Vantage tokens for {} shards'.format(shards)
+        split.append((dict(tokens, av_token=av_tokens[token]), per_minute // sharing, per_day // sharing))
+    return split
+
+
+def fetch_shard(source, tokens, timestamp, symbols, request=None, function=None, interval=None, output_format='json'):
+    """Market data of every symbol of a shard at one tick, one record per
+    symbol. IEX shards are fetched through the batch endpoint, the other
+    sources one symbol at a time, the symbols whose request failed being
+    left out."""
+    if source == 'IEX':
+        raw_data = GetData(tokens, output_format).get_iex_batch(symbols, timestamp, types=request or 'quote')
+        return [dict(raw_data[symbol], symbol=symbol, Timestamp=raw_data['Timestamp'])
+                for symbol in symbols if symbol in raw_data]
+
+    records = []
+    for symbol in symbols:
+        record = get_data_point(source, tokens, timestamp, request=request, function=function, symbol=symbol,
+                                interval=interval, output_format=output_format)
+        if record is None:
+            logging.warning('No market data for {} at this tick'.format(symbol))
+        else:
+            records.append(record)
+    return records
+
+
+def run_shard(shard, symbols, freq, source, tokens, market_hours, reports, request=None, function=None, interval=None,
+              output_format='json', missed_tick_policy='skip', av_limits=None):
+    """Body of a shard worker: sends the market data of its symbols every
+    tick until the market closes, and reports each finished tick. The Alpha
+    Vantage scheduler of the worker uses `av_limits` (per_minute, per_day)."""
+    sink = get_sink(kafka_config)
+
+    if source == 'AV':
+        get_scheduler(tokens, output_format, **(av_limits or {}))
+
+    def send_shard(timestamp):
+        records = fetch_shard(source, tokens, tick_datetime(timestamp), symbols, request=request, function=function,
+                              interval=interval, output_format=output_format)
+        sink.send_many(kafka_config['topics'][4], records)
+        reports.put((shard, timestamp, time.time(), len(records)))
+
+    scheduler = TickScheduler()
+    scheduler.add('shard_{}'.format(shard), send_shard, freq, missed_tick_policy)
+
+    try:
+        scheduler.run(until=lambda: market_is_open(market_hours))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.flush()
+
+
+class ShardSupervisor:
+    """Runs the market data of a symbol universe across `shards` worker
+    processes, each fetching and sending its own slice of the symbols every
+    tick. The market calendar is looked up once and the economic indicator,
+    COT and VIX spiders run once, in the supervisor, for every symbol.
+
+    The lag of a shard is the age of the tick it last finished, the time it
+    took to finish it being kept as its duration. Alpha Vantage budgets are
+    kept per process, so AV shards are given their own tokens, or an equal
+    share of the limits of the tokens they share (see shard_tokens).
+
+    Parameters
+    ----------
+    symbols: list
+    Symbol universe
+    shards: int
+    Number of worker processes
+    freq: int
+    Seconds between ticks
+    source: str
+    'IEX' or 'AV'
+    report_every: int
+    Seconds between two lag log lines
+    persistent_spiders: bool
+    Whether the spiders run in a persistent SpiderService
+    av_per_minute: int
+    Calls allowed per Alpha Vantage token per minute, across all shards
+    av_per_day: int
+    Calls allowed per Alpha Vantage token per day, across all shards
+    """
+    def __init__(self, symbols, shards, freq, source, tokens, economic_data, cot=False, vix=False, request=None, \
+                 function=None, interval=None, output_format='json', missed_tick_policy='skip', report_every=60, \
+                 persistent_spiders=False, av_per_minute=5, av_per_day=500):
+
+        self.shards = [symbols for symbols in shard_symbols(symbols, shards) if symbols]
+        self.freq = freq
+        self.source = source
+        self.tokens = tokens
+        self.economic_data = economic_data
+        self.cot = cot
+        self.vix = vix
+        self.request = request
+        self.function = function
+        self.interval = interval
+        self.output_format = output_format
+        self.missed_tick_policy = missed_tick_policy
+        self.report_every = report_every
+        self.persistent_spiders = persistent_spiders
+        self.av_per_minute = av_per_minute
+        self.av_per_day = av_per_day
+
+        self.reports = Queue()
+        self.workers = []
+        self.ticks = {}
+        self.started = None
+
+    def start(self, market_hours):
+        self.started = time.time()
+
+        if self.source == 'AV':
+            tokens = shard_tokens(self.tokens, len(self.shards), self.av_per_minute, self.av_per_day)
+        else:
+            tokens = [(self.tokens, None, None)] * len(self.shards)
+
+        for shard, symbols in enumerate(self.shards):
+            shard_token, per_minute, per_day = tokens[shard]
+            av_limits = {'per_minute': per_minute, 'per_day': per_day} if self.source == 'AV' else None
+            worker = Process(target=run_shard, args=(shard, symbols, self.freq, self.source, shard_token, market_hours,
+                                                     self.reports),
+                             kwargs={'request': self.request, 'function': self.function, 'interval': self.interval,
+                                     'output_format': self.output_format,
+                                     'missed_tick_policy': self.missed_tick_policy, 'av_limits': av_limits},
+                             daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def drain(self):
+        while True:
+            try:
+                shard, timestamp, finished, records = self.reports.get_nowait()
+            except queue.Empty:
+                return
+            self.ticks[shard] = (timestamp, finished, records)
+
+    def lag(self):
+        """Returns the lag, duration and record count of the last tick of
+        every shard, the lag of a shard that finished no tick yet being the
+        time since the supervisor started."""
+        self.drain()
+        now = time.time()
+
+        lags = {}
+        for shard, symbols in enumerate(self.shards):
+            if shard in self.ticks:
+                timestamp, finished, records = self.ticks[shard]
+                lags[shard] = {'lag': now - timestamp, 'duration': finished - timestamp, 'records': records,
+                               'symbols': len(symbols), 'alive': self.workers[shard].is_alive()}
+            else:
+                lags[shard] = {'lag': now - self.started, 'duration': None, 'records': 0,
+                               'symbols': len(symbols), 'alive': self.workers[shard].is_alive()}
+        return lags
+
+    def report(self, timestamp=None):
+        for shard, lag in self.lag().items():
+            logging.warning('Shard {}: lag {:.1f}s, last tick {}, {}/{} symbols{}'.format(
+                shard, lag['lag'], 'pending' if lag['duration'] is None else '{:.1f}s'.format(lag['duration']),
+                lag['records'], lag['symbols'], '' if lag['alive'] else ', worker stopped'))
+
+    def stop(self, timeout=None):
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+
+    def run(self):
+        current_datetime = pytz.utc.localize(datetime.datetime.utcnow()).astimezone(time_zone['EST'])
+        market_hours = get_market_hours(current_datetime, self.source)
+
+        spider_service = SpiderService(dict({'USER_AGENT': user_agent}, **spider_settings())).start() \
+            if self.persistent_spiders else None
+
+        scheduler = TickScheduler()
+        add_spider_sources(scheduler, self.freq, self.economic_data, cot=self.cot, vix=self.vix,
+                           missed_tick_policy=self.missed_tick_policy, spider_service=spider_service)
+        scheduler.add('lag_report', self.report, self.report_every, offset=self.report_every)
+
+        self.start(market_hours)
+        try:
+            scheduler.run(until=lambda: market_is_open(market_hours) and
+                          any(worker.is_alive() for worker in self.workers))
+        except KeyboardInterrupt:
+            logging.warning('Action suddenly stopped by the user')
+        finally:
+            self.stop()
+            self.report()
+            if spider_service is not None:
+                spider_service.stop()
+
+
+def start_sharded_session(symbols, shards, freq, source, tokens, economic_data, **kwargs):
+    """Runs a ShardSupervisor over `symbols` for the current trading day."""
+    supervisor = ShardSupervisor(symbols, shards, freq, source, tokens, economic_data, **kwargs)
+    supervisor.run()
+    return supervisor
@@ -0,0 +1,111 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ScheduledSource:
+    def __init__(self, name, fn, cadence, policy, max_catch_up, next_due):
+
+        self.name = name
+        self.fn = fn
+        self.cadence = cadence
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.next_due = next_due
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+
+
+class TickScheduler:
+    """Runs independent data sources concurrently on fixed tick boundaries of
+    a monotonic clock, each with its own cadence, so slow sources neither
+    delay the others nor make the ticks drift.
+
+    A source whose tick comes while it is still running, or that is woken
+    late, has missed ticks. The 'skip' policy runs it once and moves on to the
+    next boundary, the 'catch_up' policy runs it once per missed tick (up to
+    max_catch_up extra runs).
+
+    Parameters
+    ----------
+    max_workers: int
+    Maximum number of sources running at once
+    """
+    def __init__(self, max_workers=None, clock=time.monotonic, wall_clock=time.time):
+
+        self.max_workers = max_workers
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.sources = []
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.start = clock()
+        self.wall_start = wall_clock()
+
+    def add(self, name, fn, cadence, policy='skip', max_catch_up=3, offset=0.0):
+        """Schedules fn(tick_timestamp) every `cadence` seconds, the first
+        tick being `offset` seconds after the scheduler was created.
+        tick_timestamp is the POSIX time of the tick boundary."""
+        assert cadence > 0, 'Cadence must be positive'
+        assert policy in ('skip', 'catch_up'), '{} policy is not supported'.format(policy)
+
+        self.sources.append(ScheduledSource(name, fn, cadence, policy, max_catch_up, self.start + offset))
+
+    def tick_timestamp(self, due):
+        return self.wall_start + (due - self.start)
+
+    def execute(self, source, ticks):
+        try:
+            for due in ticks:
+                try:
+                    source.fn(self.tick_timestamp(due))
+                except Exception as msg:
+                    logging.warning('Source "{}" failed: {}'.format(source.name, msg))
+                source.runs += 1
+        finally:
+            with self.lock:
+                source.running = False
+            self.wakeup.set()
+
+    def dispatch(self, executor, now):
+        for source in self.sources:
+            with self.lock:
+                if source.running or now < source.next_due:
+                    continue
+
+                missed = int((now - source.next_due) // source.cadence)
+                first_due = source.next_due + missed * source.cadence
+
+                if source.policy == 'catch_up':
+                    extra = min(missed, source.max_catch_up)
+                    ticks = [first_due - i * source.cadence for i in range(extra, -1, -1)]
+                    source.skipped += missed - extra
+                else:
+                    ticks = [first_due]
+                    source.skipped += missed
+
+                if missed:
+                    logging.warning('Source "{}" missed {} tick(s)'.format(source.name, missed))
+
+                source.next_due = first_due + source.cadence
+                source.running = True
+
+            executor.submit(self.execute, source, ticks)
+
+    def run(self, until=lambda: True):
+        """Dispatches the sources until `until()` returns False, then waits
+        for the running ones to finish."""
+        with ThreadPoolExecutor(max_workers=self.max_workers or max(len(self.sources), 1)) as executor:
+            while until():
+                self.wakeup.clear()
+                self.dispatch(executor, self.clock())
+
+                with self.lock:
+                    idle = [source.next_due for source in self.sources if not source.running]
+                timeout = max(min(idle) - self.clock(), 0.0) if idle else None
+                self.wakeup.wait(timeout)
+
+    def stats(self):
+        return {source.name: {'runs': source.runs, 'skipped': source.skipped} for source in self.sources}